@@ -5,14 +5,35 @@ YouTube Auto Upload Script v2.0
 - Cache + Retry cho Google Sheets API (fix quota 429)
 """
 
-import os, sys, logging, time, random, shutil, ctypes, hashlib
+import os, sys, re, logging, time, random, shutil, ctypes, hashlib, hmac, json, threading, sqlite3, heapq, functools, zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote
 from types import SimpleNamespace
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, namedtuple
 from oauth2client.service_account import ServiceAccountCredentials
 import gspread
-import pyautogui
+import httplib2
 import pyperclip
 import requests
+from PIL import Image
+
+# Không có màn hình (Linux headless: KeyError 'DISPLAY') vẫn import được để chạy replay/bench/calibrate
+try:
+    import pyautogui
+except Exception:
+    pyautogui = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
 # ================== VERSION & AUTO-UPDATE ==================
 VERSION = "2.0.5"
@@ -23,7 +44,8 @@ GITHUB_REPO = "upload"      # Điền tên repo, ví dụ: "upload"
 GITHUB_BRANCH = "main"
 
 # Files/folders không được ghi đè khi update (giữ nguyên của máy local)
-UPDATE_EXCLUDE = ["creds.json", "upload.log"]
+UPDATE_EXCLUDE = ["creds.json", "upload.log", "last_hits.json", "journal.db", "metrics.json", "metrics.prom",
+                  "icon/thresholds.json", "local.json"]
 
 UPDATE_CHECK_INTERVAL = 3600  # Kiểm tra update mỗi 1 giờ
 
@@ -43,9 +65,28 @@ try:
 except Exception:
     pass
 
-pyautogui.FAILSAFE = False
+if pyautogui is not None:
+    pyautogui.FAILSAFE = False
 
 # ================== AUTO-DETECT CONFIG ==================
+def base_config():
+    """
+    Cấu hình chỉ dựa vào vị trí script (không cần .exe, không tạo thư mục) —
+    đủ cho benchmark/hiệu chỉnh/coordinator.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    folder_name = os.path.basename(script_dir)
+    return {
+        "CHANNEL_CODE": None,
+        "RUN_BROWSER_EXE": None,
+        "SPREADSHEET_NAME": folder_name.replace("upload-", "") if folder_name.startswith("upload-") else "AYS2",
+        "LOCAL_DONE_ROOT": os.path.join(os.path.expanduser("~"), "Desktop", "DONE"),
+        "SERVER_DONE_ROOT": r"\\tsclient\D\AUTO\done",
+        "SCRIPT_DIR": script_dir,
+        "ICON_DIR": os.path.join(script_dir, "icon"),
+        "CREDENTIAL_PATH": os.path.join(script_dir, "creds.json"),
+    }
+
 def detect_config():
     """
     Tự động detect CHANNEL_CODE và các đường dẫn dựa vào cấu trúc thư mục.
@@ -102,12 +143,16 @@ def detect_config():
     
     return config
 
-# Load config
-try:
-    CFG = detect_config()
-except Exception as e:
-    logging.error(f"Lỗi detect config: {e}")
-    sys.exit(1)
+# Config cơ bản lúc import; chế độ upload gọi load_upload_config() để detect kênh/trình duyệt
+CFG = base_config()
+
+def load_upload_config():
+    """Detect .exe kênh + tạo thư mục DONE (chỉ cần cho chế độ upload). Lỗi thì thoát."""
+    try:
+        CFG.update(detect_config())
+    except Exception as e:
+        logging.error(f"Lỗi detect config: {e}")
+        sys.exit(1)
 
 # ================== CONSTANTS ==================
 INPUT_SHEET = "INPUT"
@@ -125,7 +170,16 @@ IDX_LINK_BG = 58
 IDX_DATE_BI = 60
 IDX_TIME_BJ = 61
 
+# Chỉ tải các cột code dùng tới (một batch_get), dựng lại dòng đúng chỉ số như get_all_values
+SHEET_COLUMNS = {
+    INPUT_SHEET: ["A:A", "AI:AI", "AV:AV", "BB:BJ"],   # code, kênh, trạng thái, tiêu đề → giờ đăng
+    SOURCE_SHEET: ["G:G", "M:M"],                      # code, trạng thái
+}
+
 UPLOAD_URL = "https://www.youtube.com/upload"
+STUDIO_CONTENT_URL = "https://studio.youtube.com/channel/UC/videos/upload"  # Danh sách video của kênh đang đăng nhập
+STUDIO_EDIT_URL = "https://studio.youtube.com/video/{video_id}/edit"        # Mở thẳng bản nháp theo ID
+VIDEO_ID_RE = re.compile(r"(?:[?&]udvid=|/video/|youtu\.be/)([\w-]{11})")  # ID trong URL của hộp thoại upload
 FOLDER_PATTERN = os.path.join(CFG["LOCAL_DONE_ROOT"], "{code}")
 
 # Icon templates
@@ -156,11 +210,246 @@ TEMPLATES = {
     "TIEPTUC": "tieptuc.png",
     "CHEDO_HIEN_THI": "chedohienthi.png",
     "THUNNGHIEM": "thunghiem.png",
+    # Trạng thái upload (chụp từ hộp thoại upload; chưa có file thì dùng chờ cứng như cũ)
+    "UPLOAD_DONE": "taixong.png",
+    "CHECKS_DONE": "kiemtraxong.png",
+    "UPLOADING": "dangtailen.png",
+    # Nút "Chỉnh sửa bản nháp" trong danh sách video (mở lại bản nháp khi resume)
+    "DRAFT_EDIT": "chinhsuabannhap.png",
 }
 
+# Template có thể chưa có file trong icon/ (không báo lỗi khi nạp)
+OPTIONAL_TEMPLATES = {"UPLOAD_DONE", "CHECKS_DONE", "UPLOADING", "DRAFT_EDIT"}
+
 def icon(name):
     return os.path.join(ICON_DIR, TEMPLATES.get(name, name))
 
+# ================== TEMPLATE STORE ==================
+# Giải mã PNG một lần, giữ bản màu + xám trong RAM thay vì đọc lại file mỗi lần poll
+_TEMPLATE_STORE = {}
+
+def _resolve_icon_path(img_path):
+    """Tìm file icon không phân biệt hoa/thường (icon/*.PNG vs TEMPLATES *.png)."""
+    if os.path.isfile(img_path):
+        return img_path
+    folder, base = os.path.split(img_path)
+    try:
+        for f in os.listdir(folder or "."):
+            if f.lower() == base.lower():
+                return os.path.join(folder, f)
+    except Exception:
+        pass
+    return img_path
+
+# Các tỉ lệ dựng sẵn cho mỗi template (icon chụp ở 100%, máy chạy 67%–150% DPI/zoom)
+TEMPLATE_SCALES = (1.0, 1.25, 0.8, 1.5, 0.67, 1.1, 0.9, 1.75)
+
+def _build_scales(gray):
+    """Kim tự tháp template xám theo TEMPLATE_SCALES: {scale: mảng xám}."""
+    if gray is None:
+        return {1.0: None}
+    scales = {}
+    h, w = gray.shape
+    for sc in TEMPLATE_SCALES:
+        size = (max(1, round(w * sc)), max(1, round(h * sc)))
+        if sc == 1.0:
+            scales[sc] = gray
+        elif cv2 is not None:
+            scales[sc] = cv2.resize(gray, size, interpolation=cv2.INTER_AREA if sc < 1 else cv2.INTER_LINEAR)
+        else:
+            scales[sc] = np.asarray(Image.fromarray(gray).resize(size, Image.BILINEAR))
+    return scales
+
+def load_template(img_path):
+    """Lấy template đã giải mã từ store (nạp nếu chưa có)."""
+    tpl = _TEMPLATE_STORE.get(img_path)
+    if tpl is not None:
+        return tpl
+    
+    real_path = _resolve_icon_path(img_path)
+    with Image.open(real_path) as im:
+        rgb = im.convert("RGB")
+    
+    color = gray = None
+    if np is not None:
+        arr = np.asarray(rgb)
+        color = np.ascontiguousarray(arr[:, :, ::-1])  # RGB -> BGR như cv2
+        if cv2 is not None:
+            gray = cv2.cvtColor(color, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = np.asarray(rgb.convert("L"))
+    
+    tpl = SimpleNamespace(
+        path=img_path,
+        name=os.path.basename(img_path),
+        image=rgb,
+        color=color,
+        gray=gray,
+        w=rgb.size[0],
+        h=rgb.size[1],
+        scales=_build_scales(gray),
+    )
+    _TEMPLATE_STORE[img_path] = tpl
+    return tpl
+
+def template_available(name):
+    """Template có file trong icon/ không."""
+    return os.path.isfile(_resolve_icon_path(icon(name)))
+
+def preload_templates():
+    """Nạp toàn bộ TEMPLATES vào store lúc khởi động."""
+    loaded = 0
+    for name in TEMPLATES:
+        if name in OPTIONAL_TEMPLATES and not template_available(name):
+            continue
+        try:
+            load_template(icon(name))
+            loaded += 1
+        except Exception as e:
+            logging.warning(f"Không nạp được template {name}: {e}")
+    logging.info(f"🖼️ Đã nạp {loaded}/{len(TEMPLATES)} template")
+    return loaded
+
+def invalidate_templates(img_path=None):
+    """Xóa template khỏi store (gọi khi auto-update thay file trong icon/)."""
+    if img_path:
+        _TEMPLATE_STORE.pop(img_path, None)
+    else:
+        _TEMPLATE_STORE.clear()
+        load_thresholds()
+
+# Ngưỡng hiệu chỉnh offline cho từng template (python main.py --calibrate <corpus_dir>).
+# Riêng từng máy: không commit, auto-update không ghi đè (UPDATE_EXCLUDE).
+THRESHOLDS_PATH = os.path.join(ICON_DIR, "thresholds.json")
+TEMPLATE_THRESHOLDS = {}
+
+def load_thresholds():
+    """Đọc icon/thresholds.json -> TEMPLATE_THRESHOLDS {tên template: ngưỡng}."""
+    TEMPLATE_THRESHOLDS.clear()
+    try:
+        with open(THRESHOLDS_PATH, encoding="utf-8") as f:
+            TEMPLATE_THRESHOLDS.update({k: float(v) for k, v in json.load(f).items() if k in TEMPLATES})
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Không đọc được {THRESHOLDS_PATH}: {e}")
+    return TEMPLATE_THRESHOLDS
+
+def template_threshold(img_path, default):
+    """Ngưỡng đã hiệu chỉnh của template nếu có, ngược lại default."""
+    for name, thr in TEMPLATE_THRESHOLDS.items():
+        if icon(name) == img_path:
+            return thr
+    return default
+
+load_thresholds()
+
+# ================== METRICS ==================
+# Span đo thời gian quanh các bước chính: thời lượng, số lần thử, phần thời gian ngủ (nap) so với làm việc.
+# Xuất sau mỗi mã ra metrics.json + metrics.prom (textfile cho node_exporter).
+METRICS_JSON_PATH = os.path.join(CFG["SCRIPT_DIR"], "metrics.json")
+METRICS_PROM_PATH = os.path.join(CFG["SCRIPT_DIR"], "metrics.prom")
+METRICS_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)  # giây
+
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+_SPANS = threading.local()
+
+def _open_spans():
+    if not hasattr(_SPANS, "stack"):
+        _SPANS.stack = []
+    return _SPANS.stack
+
+def _record_span(name, duration, sleep, attempts, ok):
+    with _METRICS_LOCK:
+        m = _METRICS.setdefault(name, {"count": 0, "errors": 0, "sum": 0.0, "sleep": 0.0, "max": 0.0,
+                                       "attempts": 0, "buckets": [0] * len(METRICS_BUCKETS)})
+        m["count"] += 1
+        m["errors"] += 0 if ok else 1
+        m["sum"] += duration
+        m["sleep"] += sleep
+        m["max"] = max(m["max"], duration)
+        m["attempts"] += attempts
+        for i, le in enumerate(METRICS_BUCKETS):
+            if duration <= le:
+                m["buckets"][i] += 1
+
+def timed(func):
+    """Decorator: ghi một span mang tên hàm cho mỗi lần gọi."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = _open_spans()
+        span = {"sleep": 0.0, "attempts": 0}
+        stack.append(span)
+        t0, ok = time.time(), False
+        try:
+            result = func(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            stack.pop()
+            _record_span(func.__name__, time.time() - t0, span["sleep"], span["attempts"], ok)
+    return wrapper
+
+def span_attempt():
+    """Đếm thêm một lần thử cho span đang mở trong cùng."""
+    stack = _open_spans()
+    if stack:
+        stack[-1]["attempts"] += 1
+
+def nap(sec):
+    """time.sleep có ghi nhận: thời gian ngủ được cộng vào mọi span đang mở."""
+    t0 = time.time()
+    time.sleep(sec)
+    slept = time.time() - t0
+    for span in _open_spans():
+        span["sleep"] += slept
+    _record_span("nap", slept, slept, 0, True)
+
+def metrics_snapshot():
+    with _METRICS_LOCK:
+        return {name: dict(m, buckets=list(m["buckets"])) for name, m in _METRICS.items()}
+
+def _prom_text(snapshot):
+    lines = ["# TYPE upload_span_seconds histogram"]
+    for name, m in sorted(snapshot.items()):
+        for le, n in zip(METRICS_BUCKETS, m["buckets"]):
+            lines.append(f'upload_span_seconds_bucket{{span="{name}",le="{le}"}} {n}')
+        lines.append(f'upload_span_seconds_bucket{{span="{name}",le="+Inf"}} {m["count"]}')
+        lines.append(f'upload_span_seconds_sum{{span="{name}"}} {m["sum"]:.3f}')
+        lines.append(f'upload_span_seconds_count{{span="{name}"}} {m["count"]}')
+    for metric, field in (("upload_span_sleep_seconds_total", "sleep"),
+                          ("upload_span_attempts_total", "attempts"),
+                          ("upload_span_errors_total", "errors")):
+        lines.append(f"# TYPE {metric} counter")
+        for name, m in sorted(snapshot.items()):
+            lines.append(f'{metric}{{span="{name}"}} {m[field]:g}')
+    return "\n".join(lines) + "\n"
+
+def _write_atomic(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def export_metrics(code=None):
+    """Ghi metrics.json + metrics.prom và log tóm tắt tỉ lệ ngủ/làm theo span."""
+    snapshot = metrics_snapshot()
+    if not snapshot:
+        return
+    report = {"updated_at": time.time(), "last_code": code, "buckets": list(METRICS_BUCKETS), "spans": {
+        name: dict(m, avg=m["sum"] / m["count"], sleep_share=m["sleep"] / m["sum"] if m["sum"] else 0.0)
+        for name, m in snapshot.items()}}
+    try:
+        _write_atomic(METRICS_JSON_PATH, json.dumps(report, ensure_ascii=False, indent=2))
+        _write_atomic(METRICS_PROM_PATH, _prom_text(snapshot))
+    except OSError as e:
+        logging.warning(f"Không ghi được metrics: {e}")
+    
+    top = sorted(report["spans"].items(), key=lambda kv: -kv[1]["sum"])[:5]
+    logging.info("📊 Metrics: " + ", ".join(
+        f"{name} {m['sum']:.0f}s/{m['count']} lần (ngủ {m['sleep_share']:.0%})" for name, m in top))
+
 # ================== RANDOM PARAMS ==================
 RANDOM = SimpleNamespace(
     tiny=(0.5, 0.9),
@@ -168,7 +457,8 @@ RANDOM = SimpleNamespace(
     medium=(2.5, 4.0),
     long=(5.0, 8.0),
     mouse_move=(0.25, 0.45),
-    retry_screen_interval=(1.2, 2.0),
+    retry_screen_interval=(1.2, 2.0),         # poll khi chụp bằng pyautogui (mỗi lần là một screenshot đầy đủ)
+    retry_screen_interval_fast=(0.05, 0.15),  # poll khi chụp bằng mss: chụp rẻ, frame không đổi thì bỏ qua match
     browser_launch_wait_sec=(12, 20),
     click_timeout_sec=(120, 180),
     click_confidence=(0.70, 0.90),
@@ -180,7 +470,7 @@ def r(a, b):
 
 def rsleep(bucket="small"):
     lo, hi = getattr(RANDOM, bucket)
-    time.sleep(r(lo, hi))
+    nap(r(lo, hi))
 
 # ================== AUTO-UPDATE ==================
 _last_update_check = 0
@@ -223,6 +513,7 @@ def download_and_extract_repo():
             root_folder = zf.namelist()[0].split('/')[0]
             
             script_dir = CFG["SCRIPT_DIR"]
+            icons_changed = False
             
             for member in zf.namelist():
                 # Bỏ qua thư mục gốc
@@ -258,6 +549,11 @@ def download_and_extract_repo():
                     with open(target_path, 'wb') as f:
                         f.write(zf.read(member))
                     logging.info(f"✅ Cập nhật: {rel_path}")
+                    if rel_path.startswith("icon/"):
+                        icons_changed = True
+        
+        if icons_changed:
+            invalidate_templates()
         
         return True
         
@@ -319,12 +615,25 @@ def check_for_updates():
         return False
 
 # ================== GOOGLE SHEETS (với Cache + Retry) ==================
-_CACHE = {}
+# Cache snapshot theo (spreadsheet, worksheet, dải cột): TTL + giới hạn số mục (LRU),
+# nhiều luồng cùng hỏi một khóa thì chỉ một request được gửi (single-flight).
+_CACHE = OrderedDict()
 _CACHE_TTL = 120  # Cache 2 phút
+_CACHE_MAX = 16
+_CACHE_LOCK = threading.Lock()
+_INFLIGHT = {}
 
+# Snapshot lưu đĩa (bảng snapshots trong journal.db, JSON nén zlib) để sống qua restart/os.execv.
+# Chỉ dùng lại khi modifiedTime trên Drive chưa đổi kể từ lúc tải.
+SNAPSHOT_ENABLED = True
+MODIFIED_TTL = 30  # Các lần tải trong 30s dùng chung một lần hỏi modifiedTime
+_MODIFIED = {}
+
+@timed
 def retry_api_call(func, max_retries=5, base_delay=10):
     """Retry với exponential backoff khi gặp lỗi 429."""
     for attempt in range(max_retries):
+        span_attempt()
         try:
             return func()
         except Exception as e:
@@ -332,65 +641,459 @@ def retry_api_call(func, max_retries=5, base_delay=10):
             if '429' in err_str or 'Quota' in err_str:
                 delay = base_delay * (2 ** attempt)
                 logging.warning(f"⏳ Quota exceeded, đợi {delay}s (lần {attempt+1}/{max_retries})...")
-                time.sleep(delay)
+                nap(delay)
             else:
                 raise e
     raise Exception(f"Hết {max_retries} lần retry")
 
-def cached_get_all_values(ws, cache_key):
-    """Lấy dữ liệu từ cache nếu còn hạn."""
-    now = time.time()
-    if cache_key in _CACHE:
-        data, ts = _CACHE[cache_key]
-        if now - ts < _CACHE_TTL:
+def _col_index(letters):
+    """'A' -> 0, 'AI' -> 34, 'BJ' -> 61."""
+    n = 0
+    for ch in letters.upper():
+        n = n * 26 + ord(ch) - ord("A") + 1
+    return n - 1
+
+def _col_letters(col):
+    """13 -> 'M', 48 -> 'AV' (cột đánh số từ 1)."""
+    letters = ""
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+def get_projected_values(ws, ranges):
+    """
+    Tải các dải cột bằng một batch_get rồi ghép lại thành dòng đầy đủ:
+    cột không tải để "", mọi dòng dài bằng cột cuối cùng được chọn (giống get_all_values).
+    """
+    spans = []
+    for rng in ranges:
+        first, _, last = rng.partition(":")
+        spans.append((_col_index(first), _col_index(last or first)))
+    width = max(end for _, end in spans) + 1
+    
+    blocks = retry_api_call(lambda: ws.batch_get(ranges, major_dimension="ROWS"))
+    height = max((len(b) for b in blocks), default=0)
+    rows = [[""] * width for _ in range(height)]
+    for (start, end), block in zip(spans, blocks):
+        for i, values in enumerate(block):
+            rows[i][start:start + len(values)] = [str(v) for v in values[:end - start + 1]]
+    
+    # Bỏ dòng trống cuối (get_all_values cũng không trả về chúng)
+    while rows and not any(rows[-1]):
+        rows.pop()
+    return rows
+
+def cached_get_all_values(ws, cache_key, ranges=None):
+    """
+    Lấy dữ liệu từ cache nếu còn hạn. cache_key = (spreadsheet, worksheet, dải cột).
+    ranges: chỉ tải các dải cột này (xem SHEET_COLUMNS).
+    """
+    with _CACHE_LOCK:
+        hit = _CACHE.get(cache_key)
+        if hit and time.time() - hit[1] < _CACHE_TTL:
+            _CACHE.move_to_end(cache_key)
             logging.debug(f"📦 Cache hit: {cache_key}")
-            return data
+            return hit[0]
+        flight = _INFLIGHT.get(cache_key)
+        leader = flight is None
+        if leader:
+            flight = _INFLIGHT[cache_key] = {"done": threading.Event()}
+    
+    if not leader:  # Đã có luồng khác đang tải khóa này -> dùng chung kết quả
+        flight["done"].wait()
+        if "error" in flight:
+            raise flight["error"]
+        return flight["data"]
     
-    data = retry_api_call(ws.get_all_values)
-    _CACHE[cache_key] = (data, now)
+    try:
+        data = _load_snapshot_or_fetch(ws, cache_key, ranges)
+        flight["data"] = data
+        with _CACHE_LOCK:
+            _CACHE[cache_key] = (data, time.time())
+            _CACHE.move_to_end(cache_key)
+            while len(_CACHE) > _CACHE_MAX:
+                _CACHE.popitem(last=False)
+        return data
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        with _CACHE_LOCK:
+            _INFLIGHT.pop(cache_key, None)
+        flight["done"].set()
+
+def _remote_modified():
+    """modifiedTime của spreadsheet, nhớ trong MODIFIED_TTL giây."""
+    now = time.time()
+    if now - _MODIFIED.get("ts", 0) >= MODIFIED_TTL:
+        _MODIFIED.update(value=sheet_modified_time(), ts=now)
+    return _MODIFIED["value"]
+
+def _load_snapshot_or_fetch(ws, cache_key, ranges):
+    """Dùng snapshot trên đĩa nếu sheet chưa đổi; ngược lại tải mới và lưu lại."""
+    snap_key = json.dumps(list(cache_key), ensure_ascii=False)
+    modified = _remote_modified() if SNAPSHOT_ENABLED else None
+    if modified:
+        row = _journal_exec("SELECT modified, data FROM snapshots WHERE key = ?", (snap_key,)).fetchone()
+        if row and row["modified"] == modified:
+            logging.debug(f"💾 Snapshot còn hiệu lực: {cache_key[1]} ({modified})")
+            return json.loads(zlib.decompress(row["data"]).decode("utf-8"))
+    
+    if ranges and hasattr(ws, "batch_get"):
+        data = get_projected_values(ws, ranges)
+    else:
+        data = retry_api_call(ws.get_all_values)
+    
+    if modified:  # modifiedTime lấy TRƯỚC khi tải: sheet đổi trong lúc tải thì lần sau sẽ lệch và tải lại
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        _journal_exec("INSERT OR REPLACE INTO snapshots (key, sheet, modified, data, saved_at) VALUES (?, ?, ?, ?, ?)",
+                      (snap_key, cache_key[1], modified, blob, time.time()))
     return data
 
-def invalidate_cache(cache_key=None):
-    """Xóa cache."""
-    global _CACHE
-    if cache_key:
-        _CACHE.pop(cache_key, None)
+def sheet_values(sheet_name):
+    """Snapshot (đã cache) của worksheet, chỉ gồm các cột trong SHEET_COLUMNS."""
+    ranges = SHEET_COLUMNS.get(sheet_name)
+    ws = gs_worksheet(sheet_name)
+    return cached_get_all_values(ws, (gs_spreadsheet().id, sheet_name, tuple(ranges or ())), ranges)
+
+def patch_cache(sheet_name, row, col, value):
+    """
+    Sửa bản cache sau khi chính mình ghi (row/col đánh số từ 1 như update_cell)
+    thay vì xóa cả snapshot. Bỏ qua snapshot không chứa cột đó.
+    """
+    with _CACHE_LOCK:
+        for (_, name, ranges), (data, _) in _CACHE.items():
+            if name != sheet_name or row > len(data):
+                continue
+            spans = [rng.partition(":")[::2] for rng in ranges]
+            if ranges and not any(_col_index(a) <= col - 1 <= _col_index(b or a) for a, b in spans):
+                continue
+            cells = data[row - 1]
+            if len(cells) < col:
+                cells.extend([""] * (col - len(cells)))
+            cells[col - 1] = value
+    # Bản trên đĩa gắn với modifiedTime cũ -> bỏ, lần tải kế tiếp sẽ lưu lại
+    _journal_exec("DELETE FROM snapshots WHERE sheet = ?", (sheet_name,))
+
+def invalidate_cache(sheet_name=None):
+    """Xóa cache của một worksheet, hoặc toàn bộ (kèm modifiedTime đã nhớ)."""
+    with _CACHE_LOCK:
+        for key in [k for k in _CACHE if sheet_name is None or k[1] == sheet_name]:
+            del _CACHE[key]
+        if sheet_name is None:
+            _MODIFIED.clear()
+
+# Phiên dùng chung: authorize một lần, tìm spreadsheet theo tên một lần (sau đó open_by_key),
+# giữ sẵn handle worksheet, làm mới token trước khi hết hạn.
+GS_SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+GS_REFRESH_MARGIN = 5 * 60  # Làm mới token khi còn dưới 5 phút
+_GS = {}
+_GS_LOCK = threading.RLock()
+
+def _session_auth(client):
+    """Credential mà session HTTP của gspread thực sự dùng (gspread tự đổi creds oauth2client sang google-auth)."""
+    return getattr(getattr(client, "http_client", client), "auth", None)
+
+def _token_expiring(auth):
+    # google-auth: .expiry; oauth2client (gspread cũ): .token_expiry — cả hai là giờ UTC không kèm tzinfo
+    expiry = getattr(auth, "expiry", None) or getattr(auth, "token_expiry", None)
+    if expiry is None:
+        return False
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (expiry - now).total_seconds() < GS_REFRESH_MARGIN
+
+def _refresh_token(auth):
+    """Làm mới token ngay trên credential của session (session dùng lại luôn, không cần authorize lại)."""
+    if hasattr(auth, "token_expiry"):
+        auth.refresh(httplib2.Http())
     else:
-        _CACHE.clear()
+        from google.auth.transport.requests import Request
+        auth.refresh(Request())
 
 def gs_client():
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_name(CFG["CREDENTIAL_PATH"], scope)
-    return gspread.authorize(creds)
+    """Client gspread của phiên (tạo một lần, tự làm mới token sắp hết hạn). None khi dùng sheet local."""
+    with _GS_LOCK:
+        if SHEETS_LOCAL_DIR:
+            return None
+        if "client" not in _GS:
+            creds = ServiceAccountCredentials.from_json_keyfile_name(CFG["CREDENTIAL_PATH"], GS_SCOPE)
+            _GS.update(client=gspread.authorize(creds), worksheets={})
+        else:
+            auth = _session_auth(_GS["client"])
+            if _token_expiring(auth):
+                logging.info("🔑 Làm mới token Google trước khi hết hạn")
+                _refresh_token(auth)
+        return _GS["client"]
 
-def get_rows(client, sheet_name):
-    ws = client.open(CFG["SPREADSHEET_NAME"]).worksheet(sheet_name)
-    return cached_get_all_values(ws, f"rows_{sheet_name}")
+def gs_spreadsheet():
+    """Spreadsheet của phiên; lần đầu tìm theo tên (Drive search), các lần sau mở theo key."""
+    with _GS_LOCK:
+        client = gs_client()
+        if "spreadsheet" not in _GS:
+            if SHEETS_LOCAL_DIR:
+                _GS.update(spreadsheet=_local_spreadsheet(SHEETS_LOCAL_DIR), worksheets={})
+            elif _GS.get("key"):
+                _GS["spreadsheet"] = retry_api_call(lambda: client.open_by_key(_GS["key"]))
+            else:
+                _GS["spreadsheet"] = retry_api_call(lambda: client.open(CFG["SPREADSHEET_NAME"]))
+                _GS["key"] = _GS["spreadsheet"].id
+        return _GS["spreadsheet"]
 
-def update_source_status(client, code, status="ĐÃ ĐĂNG"):
-    """Cập nhật trạng thái với cache + retry."""
-    try:
-        ws = client.open(CFG["SPREADSHEET_NAME"]).worksheet(SOURCE_SHEET)
-        rows = cached_get_all_values(ws, f"source_{SOURCE_SHEET}")
-        
-        for i, row in enumerate(rows[1:], start=2):
-            if len(row) > 12 and norm(row[6]) == code:
-                retry_api_call(lambda: ws.update_cell(i, 13, status))
-                logging.info(f"✅ Đã cập nhật '{status}' cho mã {code}")
-                invalidate_cache(f"source_{SOURCE_SHEET}")
-                return True
-        
-        logging.warning(f"Không tìm thấy mã {code} trong sheet {SOURCE_SHEET}")
-        return False
-    except Exception as e:
-        logging.error(f"Lỗi update status: {e}")
-        return False
+def gs_worksheet(sheet_name):
+    """Handle worksheet đã cache theo tên."""
+    with _GS_LOCK:
+        spreadsheet = gs_spreadsheet()
+        if sheet_name not in _GS["worksheets"]:
+            _GS["worksheets"][sheet_name] = retry_api_call(lambda: spreadsheet.worksheet(sheet_name))
+        return _GS["worksheets"][sheet_name]
+
+def get_rows(sheet_name):
+    return sheet_values(sheet_name)
+
+# ---- Sheet local (thay cho Google Sheets khi thử nghiệm) ----
+# Mỗi worksheet là <dir>/<tên>.json chứa list các dòng; modifiedTime = mtime mới nhất của các file.
+SHEETS_LOCAL_DIR = None
+
+def set_sheets_backend(local_dir=None):
+    """Chuyển tầng Sheets sang thư mục local (local_dir) hoặc về Google Sheets (None)."""
+    global SHEETS_LOCAL_DIR
+    with _GS_LOCK:
+        SHEETS_LOCAL_DIR = local_dir
+        _GS.clear()
+    invalidate_cache()
+
+def _cell_ref(ref):
+    """'M5' -> (5, 13)."""
+    letters = ref.rstrip("0123456789")
+    return int(ref[len(letters):]), _col_index(letters) + 1
+
+def _local_worksheet(path, title):
+    def read():
+        with open(path, encoding="utf-8") as f:
+            return [[str(v) for v in row] for row in json.load(f)]
+    
+    def write(rows):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    
+    def batch_get(ranges, major_dimension="ROWS"):
+        rows, blocks = read(), []
+        for rng in ranges:
+            first, _, last = rng.partition(":")
+            start, end = _col_index(first), _col_index(last or first)
+            block = [row[start:end + 1] for row in rows]
+            for values in block:
+                while values and values[-1] == "":
+                    values.pop()
+            while block and not block[-1]:
+                block.pop()
+            blocks.append(block)
+        return blocks
+    
+    def update_cell(row, col, value):
+        rows = read()
+        rows.extend([] for _ in range(row - len(rows)))
+        cells = rows[row - 1]
+        cells.extend([""] * (col - len(cells)))
+        cells[col - 1] = str(value)
+        write(rows)
+    
+    def batch_update(updates):
+        for u in updates:
+            update_cell(*_cell_ref(u["range"]), u["values"][0][0])
+    
+    return SimpleNamespace(title=title, get_all_values=read, batch_get=batch_get,
+                           update_cell=update_cell, batch_update=batch_update)
+
+def _local_spreadsheet(local_dir):
+    def worksheet(title):
+        path = os.path.join(local_dir, f"{title}.json")
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return _local_worksheet(path, title)
+    
+    def modified_time():
+        files = [os.path.join(local_dir, f) for f in os.listdir(local_dir) if f.endswith(".json")]
+        mtime = max((os.path.getmtime(f) for f in files), default=0)
+        return datetime.fromtimestamp(mtime, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    
+    return SimpleNamespace(id=f"local:{os.path.abspath(local_dir)}", worksheet=worksheet, modified_time=modified_time)
+
+# ---- Hàng đợi ghi trạng thái: bền trong journal.db, ghi lô bằng một batch_update mỗi sheet ----
+# Ghi lại cùng một giá trị là vô hại (idempotent) nên crash giữa chừng chỉ cần flush lại.
+STATUS_TARGETS = {
+    SOURCE_SHEET: (7, 13),            # NGUON: G = code, M = trạng thái
+    INPUT_SHEET: (1, STATUS_COL),     # INPUT: A = code, AV = trạng thái
+}
+STATUS_FLUSH_SEC = 5 * 60   # Gom trạng thái: ghi khi mục cũ nhất đã chờ 5 phút
+STATUS_MAX_ATTEMPTS = 10    # Quá số lần này (vd: không tìm thấy mã) thì bỏ, chỉ giữ lại log
+_STATUS_FLUSH = {"last": 0.0}
+_STATUS_FLUSH_LOCK = threading.Lock()
+
+def queue_status(code, status, sheets=None):
+    """Xếp trạng thái của mã vào hàng đợi cho các sheet trong STATUS_TARGETS."""
+    now = time.time()
+    for sheet_name in sheets or STATUS_TARGETS:
+        _journal_exec("INSERT INTO status_queue (sheet, code, status, attempts, queued_at) VALUES (?, ?, ?, 0, ?) "
+                      "ON CONFLICT(sheet, code) DO UPDATE SET status = excluded.status, attempts = 0, "
+                      "last_error = NULL, queued_at = excluded.queued_at, written_at = NULL "
+                      "WHERE status IS NOT excluded.status OR written_at IS NULL",
+                      (sheet_name, code, status, now))
+
+def pending_statuses():
+    """{sheet: {code: status}} còn chờ ghi."""
+    pending = {}
+    for row in _journal_exec("SELECT sheet, code, status FROM status_queue WHERE written_at IS NULL "
+                             "AND attempts < ?", (STATUS_MAX_ATTEMPTS,)).fetchall():
+        pending.setdefault(row["sheet"], {})[row["code"]] = row["status"]
+    return pending
+
+def _oldest_pending_status():
+    """queued_at của mục chờ ghi lâu nhất, None nếu hàng đợi rỗng."""
+    row = _journal_exec("SELECT MIN(queued_at) AS oldest FROM status_queue WHERE written_at IS NULL "
+                        "AND attempts < ?", (STATUS_MAX_ATTEMPTS,)).fetchone()
+    return row["oldest"]
+
+def write_statuses(sheet_name, statuses):
+    """
+    Ghi {code: status} vào cột trạng thái của sheet bằng MỘT lần đọc (snapshot) + MỘT batch_update.
+    Ô đã đúng giá trị thì bỏ qua. Trả về tập mã đã có trạng thái đúng trên sheet.
+    """
+    code_col, status_col = STATUS_TARGETS[sheet_name]
+    ws = gs_worksheet(sheet_name)
+    rows = sheet_values(sheet_name)
+    
+    targets, written = {}, set()
+    for i, row in enumerate(rows[1:], start=2):
+        code = norm(row[code_col - 1]) if len(row) >= code_col else None
+        if code not in statuses or code in written or code in targets.values():
+            continue
+        current = row[status_col - 1].strip() if len(row) >= status_col else ""
+        if current == statuses[code]:
+            written.add(code)
+        else:
+            targets[i] = code
+    
+    if targets:
+        col = _col_letters(status_col)
+        retry_api_call(lambda: ws.batch_update(
+            [{"range": f"{col}{i}", "values": [[statuses[code]]]} for i, code in targets.items()]))
+        for i, code in targets.items():
+            patch_cache(sheet_name, i, status_col, statuses[code])
+        written.update(targets.values())
+        logging.info(f"✅ {sheet_name}: đã ghi trạng thái {len(targets)} mã: {sorted(targets.values())}")
+    return written
+
+def flush_status_queue(force=True):
+    """
+    Ghi các trạng thái đang chờ. force=False: chỉ ghi khi mục cũ nhất đã chờ quá STATUS_FLUSH_SEC
+    (và lần thử trước cũng đã cách đủ lâu, để lỗi API không bị thử lại sau từng mã).
+    Lỗi API giữ nguyên hàng đợi để lần sau thử lại. Trả về số ô đã xác nhận.
+    """
+    with _STATUS_FLUSH_LOCK:
+        oldest = _oldest_pending_status()
+        if oldest is None:
+            return 0
+        now = time.time()
+        if not force and (now - oldest < STATUS_FLUSH_SEC or now - _STATUS_FLUSH["last"] < STATUS_FLUSH_SEC):
+            return 0
+        _STATUS_FLUSH["last"] = time.time()
+        done = 0
+        for sheet_name, statuses in pending_statuses().items():
+            try:
+                written = write_statuses(sheet_name, statuses)
+            except Exception as e:
+                logging.warning(f"Lỗi ghi trạng thái {sheet_name}: {e} (sẽ thử lại)")
+                written, error = set(), str(e)
+            else:
+                error = "Không tìm thấy mã"
+            now = time.time()
+            for code, status in statuses.items():
+                if code in written:
+                    _journal_exec("UPDATE status_queue SET written_at = ? WHERE sheet = ? AND code = ? AND status = ?",
+                                  (now, sheet_name, code, status))
+                else:
+                    _journal_exec("UPDATE status_queue SET attempts = attempts + 1, last_error = ? "
+                                  "WHERE sheet = ? AND code = ? AND status = ?", (error, sheet_name, code, status))
+            missing = set(statuses) - written
+            if missing:
+                logging.warning(f"{sheet_name}: chưa ghi được {sorted(missing)} ({error})")
+            done += len(written)
+        return done
 
 # ================== HELPERS ==================
+# ---- Display geometry: tính 1 lần, chỉ đo lại khi độ phân giải/DPI đổi ----
+_DISPLAY = {}
+
+def _physical_size():
+    """Kích thước vật lý màn hình chính, không cần chụp màn hình nếu có WinAPI."""
+    size = capture_backend()["size"]()
+    if size:
+        return tuple(size)
+    try:
+        user32, gdi32 = ctypes.windll.user32, ctypes.windll.gdi32
+        hdc = user32.GetDC(0)
+        try:
+            w, h = gdi32.GetDeviceCaps(hdc, 118), gdi32.GetDeviceCaps(hdc, 117)  # DESKTOPHORZRES/VERTRES
+        finally:
+            user32.ReleaseDC(0, hdc)
+        if w and h:
+            return w, h
+    except Exception:
+        pass
+    image, gray = capture_backend()["grab"]()
+    return (gray.shape[1], gray.shape[0]) if gray is not None else tuple(image.size)
+
+def _monitor_layout():
+    """(số màn hình, (x, y, w, h) của virtual screen) hoặc None nếu không lấy được."""
+    try:
+        gsm = ctypes.windll.user32.GetSystemMetrics
+        return gsm(80), (gsm(76), gsm(77), gsm(78), gsm(79))  # SM_CMONITORS, SM_*VIRTUALSCREEN
+    except Exception:
+        return None
+
+def get_display(refresh=False):
+    """Thông tin màn hình (logical, physical, scale, monitors). Chỉ đo lại khi kích thước logic đổi."""
+    # Không có pyautogui (headless/replay): không có tọa độ logic riêng, coi như bằng frame
+    logical = tuple(pyautogui.size()) if pyautogui is not None else (_DISPLAY.get("frame") or _physical_size())
+    if _DISPLAY and not refresh and _DISPLAY["logical"] == logical:
+        return _DISPLAY
+    
+    # Tọa độ match nằm trong không gian frame chụp được -> ưu tiên kích thước frame thật
+    physical = _DISPLAY.get("frame") or _physical_size()
+    changed = "logical" in _DISPLAY and (_DISPLAY["logical"], _DISPLAY["physical"]) != (logical, physical)
+    _DISPLAY.update(
+        logical=logical,
+        physical=physical,
+        scale=(physical[0] / (logical[0] or 1), physical[1] / (logical[1] or 1)),
+        monitors=_monitor_layout(),
+    )
+    logging.info(f"🖥️ Màn hình: logical={logical} physical={physical} "
+                 f"scale={_DISPLAY['scale'][0]:.2f}x{_DISPLAY['scale'][1]:.2f}")
+    # Vị trí cũ / tỉ lệ template đã chốt không còn đúng khi đổi độ phân giải
+    hits = _load_last_hits()
+    if changed or hits.get("__display__") not in (None, list(physical)):
+        forget_hits()
+        hits = _load_last_hits()
+    hits["__display__"] = list(physical)
+    return _DISPLAY
+
+def note_frame_size(w, h):
+    """
+    Gọi với kích thước mỗi frame chụp được. Chỉ đo lại khi kích thước frame ĐỔI so với frame trước
+    (không so với GetDeviceCaps, vốn có thể lệch cố định với ảnh chụp).
+    """
+    if _DISPLAY.get("frame") == (w, h):
+        return
+    _DISPLAY["frame"] = (w, h)
+    if not _DISPLAY.get("physical") or _DISPLAY["physical"] != (w, h):
+        get_display(refresh=True)
+
 def _get_scale():
-    sw, sh = pyautogui.size()
-    iw, ih = pyautogui.screenshot().size
-    return iw / (sw or 1), ih / (sh or 1)
+    return get_display()["scale"]
 
 def _to_logical(x, y):
     sx, sy = _get_scale()
@@ -464,46 +1167,610 @@ def close_browsers():
     open_run_and_execute(skill)
     rsleep("small")
 
+# ================== SCREEN CAPTURE ==================
+# Backend chụp màn hình: "auto" (mss nếu có, ngược lại pyautogui), "mss", "pyautogui", "replay"
+CAPTURE_BACKEND = "auto"
+
+# Mỗi backend: grab() -> (ảnh PIL hoặc None, mảng xám hoặc None); size() -> (w, h) hoặc None
+_CAPTURE = {}
+
+def _pyautogui_backend():
+    def grab():
+        image = pyautogui.screenshot()
+        gray = None
+        if np is not None:
+            if cv2 is not None:
+                gray = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2GRAY)
+            else:
+                gray = np.asarray(image.convert("L"))
+        return image, gray
+    return {"name": "pyautogui", "grab": grab, "size": lambda: None}
+
+def _mss_backend():
+    """
+    Chụp bằng mss (GDI BitBlt), đọc thẳng buffer BGRA bằng numpy, không tạo ảnh PIL.
+    Ảnh xám ghi vào một buffer cấp phát sẵn -> frame chỉ hợp lệ đến lần chụp kế tiếp.
+    """
+    import mss
+    sct = mss.mss()
+    monitor = sct.monitors[1]
+    buf = {"gray": None}
+    
+    def grab():
+        shot = sct.grab(monitor)
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        gray = buf["gray"]
+        if gray is None or gray.shape != bgra.shape[:2]:
+            gray = buf["gray"] = np.empty(bgra.shape[:2], dtype=np.uint8)
+        if cv2 is not None:
+            cv2.cvtColor(bgra, cv2.COLOR_BGRA2GRAY, dst=gray)
+        else:
+            # Không có OpenCV: trọng số BT.601 như cv2 (thứ tự B, G, R)
+            gray[...] = bgra[:, :, :3] @ np.array([0.114, 0.587, 0.299], dtype=np.float32)
+        return None, gray
+    
+    return {"name": "mss", "grab": grab, "size": lambda: (monitor["width"], monitor["height"])}
+
+def _replay_backend(replay_dir):
+    """Phát lại các file PNG trong thư mục theo thứ tự tên (giữ frame cuối khi hết) — dùng cho test/benchmark."""
+    files = sorted(f for f in os.listdir(replay_dir) if f.lower().endswith(".png"))
+    if not files:
+        raise RuntimeError(f"Không có ảnh PNG trong {replay_dir}")
+    state = {"idx": 0, "frames": {}}
+    
+    def load(name):
+        if name not in state["frames"]:
+            with Image.open(os.path.join(replay_dir, name)) as im:
+                image = im.convert("RGB")
+            gray = np.asarray(image.convert("L")) if np is not None else None
+            state["frames"][name] = (image, gray)
+        return state["frames"][name]
+    
+    def grab():
+        name = files[min(state["idx"], len(files) - 1)]
+        state["idx"] += 1
+        return load(name)
+    
+    return {"name": "replay", "grab": grab, "size": lambda: load(files[0])[0].size,
+            "files": files, "dir": replay_dir}
+
+def set_capture_backend(name="auto", replay_dir=None):
+    """Chọn backend chụp màn hình. Trả về tên backend thực sự được dùng."""
+    backend = None
+    if name == "replay":
+        backend = _replay_backend(replay_dir)
+    elif name in ("auto", "mss") and np is not None:
+        try:
+            backend = _mss_backend()
+        except Exception as e:
+            if name == "mss":
+                raise
+            logging.debug(f"Không dùng được mss: {e}")
+    if backend is None:
+        if pyautogui is None:
+            raise RuntimeError("Không có pyautogui/mss để chụp màn hình (dùng backend replay)")
+        backend = _pyautogui_backend()
+    _CAPTURE.clear()
+    _CAPTURE.update(backend)
+    _DISPLAY.clear()
+    logging.info(f"📸 Capture backend: {backend['name']}")
+    return backend["name"]
+
+def capture_backend():
+    if not _CAPTURE:
+        set_capture_backend(CAPTURE_BACKEND)
+    return _CAPTURE
+
+def poll_interval():
+    """Khoảng nghỉ giữa hai lần chụp khi chờ ảnh: poll nhanh chỉ khi chụp bằng mss."""
+    fast = capture_backend()["name"] == "mss"
+    return r(*(RANDOM.retry_screen_interval_fast if fast else RANDOM.retry_screen_interval))
+
 # ================== IMAGE RECOGNITION ==================
-def wait_image(img_path, timeout_sec=30, confidence=0.85):
-    """Chờ ảnh xuất hiện, trả về vị trí hoặc None."""
-    logging.info(f"Chờ ảnh: {os.path.basename(img_path)}...")
+# Vị trí tâm template (cùng dạng với pyautogui.Point, không phụ thuộc pyautogui)
+Point = namedtuple("Point", "x y")
+
+# Thang confidence dự phòng khi ảnh không khớp ở mức yêu cầu
+CONF_LEVELS = [0.8, 0.75, 0.7, 0.65, 0.6]
+
+def grab_frame():
+    """Chụp màn hình MỘT lần cho cả lượt poll (dùng chung cho mọi template/ngưỡng)."""
+    image, gray = capture_backend()["grab"]()
+    w, h = (gray.shape[1], gray.shape[0]) if gray is not None else image.size
+    note_frame_size(w, h)
+    return SimpleNamespace(image=image, gray=gray, w=w, h=h,
+                           ts=time.time(), scores={}, sig=frame_signature(image, gray))
+
+def frame_signature(image, gray=None, step=8):
+    """Hash rẻ của frame đã thu nhỏ, dùng để biết màn hình có thay đổi giữa hai lần chụp không."""
+    if gray is not None:
+        small = (gray[::step, ::step] >> 3).tobytes()
+    else:
+        small = image.convert("L").resize((max(1, image.size[0] // step), max(1, image.size[1] // step))).tobytes()
+    return hashlib.md5(small).hexdigest()
+
+# Vị trí khớp gần nhất của mỗi template (lưu qua các lần chạy) -> tìm trong vùng nhỏ quanh đó trước
+LAST_HITS_PATH = os.path.join(CFG["SCRIPT_DIR"], "last_hits.json")
+ROI_MARGIN = 80  # px mở rộng quanh vị trí cũ
+_LAST_HITS = None
+_HITS_LOCK = threading.RLock()  # match chạy song song trên thread pool
+
+def _load_last_hits():
+    global _LAST_HITS
+    if _LAST_HITS is None:
+        try:
+            with open(LAST_HITS_PATH, encoding="utf-8") as f:
+                _LAST_HITS = json.load(f)
+        except Exception:
+            _LAST_HITS = {}
+    return _LAST_HITS
+
+def remember_hit(tpl, x, y):
+    """Ghi nhớ vị trí khớp của template (tâm, toạ độ vật lý)."""
+    with _HITS_LOCK:
+        hits = _load_last_hits()
+        if hits.get(tpl.name) == [x, y]:
+            return
+        hits[tpl.name] = [x, y]
+        _save_last_hits()
+
+def _save_last_hits():
+    if not LAST_HITS_PATH:  # Benchmark/calibration: chỉ giữ trong RAM
+        return
+    with _HITS_LOCK:
+        try:
+            with open(LAST_HITS_PATH, "w", encoding="utf-8") as f:
+                json.dump(dict(_load_last_hits()), f)
+        except Exception as e:
+            logging.debug(f"Không lưu được last_hits: {e}")
+
+# Phiếu bầu tỉ lệ: cùng một tỉ lệ khớp SCALE_LOCK_HITS lần liên tiếp (ở ngưỡng cao nhất của caller) thì chốt;
+# đã chốt mà trượt cả màn hình SCALE_UNLOCK_MISSES lần liên tiếp thì bỏ chốt, thử lại mọi tỉ lệ
+_SCALE_VOTES = {"scale": None, "n": 0, "misses": 0}
+
+def vote_hit_scale(scale):
+    """Ghi nhận tỉ lệ vừa khớp; trả về True khi đủ phiếu để chốt."""
+    with _HITS_LOCK:
+        if _SCALE_VOTES["scale"] != scale:
+            _SCALE_VOTES.update(scale=scale, n=0)
+        _SCALE_VOTES["n"] += 1
+        return _SCALE_VOTES["n"] >= SCALE_LOCK_HITS
+
+def remember_hit_scale(scale):
+    """Chốt tỉ lệ template cho màn hình hiện tại."""
+    logging.info(f"🔍 Chốt tỉ lệ template: {scale}")
+    with _HITS_LOCK:
+        _load_last_hits()["__scale__"] = scale
+        _SCALE_VOTES["misses"] = 0
+        _save_last_hits()
+
+def note_locked_result(hit):
+    """Kết quả quét cả màn hình ở tỉ lệ đã chốt; trượt liên tiếp quá nhiều thì bỏ chốt (có thể đã chốt nhầm)."""
+    with _HITS_LOCK:
+        if hit:
+            _SCALE_VOTES["misses"] = 0
+            return
+        _SCALE_VOTES["misses"] += 1
+        if _SCALE_VOTES["misses"] < SCALE_UNLOCK_MISSES:
+            return
+        scale = _load_last_hits().pop("__scale__", None)
+        _SCALE_VOTES.update(scale=None, n=0, misses=0)
+        _save_last_hits()
+    logging.warning(f"🔍 Bỏ chốt tỉ lệ {scale}: trượt {SCALE_UNLOCK_MISSES} lần liên tiếp, thử lại mọi tỉ lệ")
+
+def forget_hits():
+    """Xóa toàn bộ vị trí đã nhớ (ví dụ khi đổi độ phân giải)."""
+    global _LAST_HITS
+    _LAST_HITS = {}
+    _SCALE_VOTES.update(scale=None, n=0, misses=0)
+    try:
+        os.remove(LAST_HITS_PATH)
+    except Exception:
+        pass
+
+def _roi_box(frame, name, w, h):
+    """Vùng tìm kiếm quanh vị trí cũ (x0, y0, x1, y1) hoặc None."""
+    last = _load_last_hits().get(name)
+    if not last:
+        return None
+    x0 = max(0, last[0] - w // 2 - ROI_MARGIN)
+    y0 = max(0, last[1] - h // 2 - ROI_MARGIN)
+    x1 = min(frame.w, last[0] + w // 2 + ROI_MARGIN)
+    y1 = min(frame.h, last[1] + h // 2 + ROI_MARGIN)
+    if x1 - x0 < w or y1 - y0 < h:
+        return None
+    return x0, y0, x1, y1
+
+# ---- NumPy/FFT NCC: dự phòng khi không có OpenCV ----
+NCC_DOWNSAMPLE = 2        # Quét thô trên ảnh thu nhỏ rồi tinh chỉnh ở độ phân giải gốc
+NCC_MIN_COARSE_SIDE = 12  # Template nhỏ hơn mức này (sau thu nhỏ) thì quét thẳng độ phân giải gốc
+
+def _ncc_map(image, tpl):
+    """Bản đồ TM_CCOEFF_NORMED (vị trí hợp lệ) của tpl trên image, tính tử số bằng FFT."""
+    image = image.astype(np.float64)
+    tpl = tpl.astype(np.float64)
+    H, W = image.shape
+    h, w = tpl.shape
+    t = tpl - tpl.mean()
+    t_norm = np.sqrt((t * t).sum())
+    
+    # Tử số: tương quan vòng (không bị cuộn ở vùng hợp lệ vì tpl đặt ở góc trên trái)
+    num = np.fft.irfft2(np.fft.rfft2(image) * np.conj(np.fft.rfft2(t, s=(H, W))), s=(H, W))[:H - h + 1, :W - w + 1]
+    
+    # Mẫu số: độ lệch chuẩn từng cửa sổ qua ảnh tích phân
+    def window_sum(a):
+        c = np.zeros((H + 1, W + 1))
+        c[1:, 1:] = a.cumsum(0).cumsum(1)
+        return c[h:, w:] - c[:-h, w:] - c[h:, :-w] + c[:-h, :-w]
+    
+    n = h * w
+    s1 = window_sum(image)
+    var = np.maximum(window_sum(image * image) - s1 * s1 / n, 0)
+    denom = np.sqrt(var) * t_norm
+    out = np.zeros_like(num)
+    ok = denom > 1e-6 * n
+    out[ok] = num[ok] / denom[ok]
+    return np.clip(out, -1.0, 1.0)
+
+def _downsample(a, f):
+    h, w = (a.shape[0] // f) * f, (a.shape[1] // f) * f
+    return a[:h, :w].reshape(h // f, f, w // f, f).mean(axis=(1, 3))
+
+def ncc_match(image, tpl):
+    """Điểm khớp tốt nhất (score, x, y) — góc trên trái — của tpl trên image bằng NCC."""
+    H, W = image.shape
+    h, w = tpl.shape
+    if h > H or w > W:
+        return (0.0, None, None)
+    
+    f = NCC_DOWNSAMPLE
+    if f <= 1 or min(h, w) // f < NCC_MIN_COARSE_SIDE:
+        res = _ncc_map(image, tpl)
+        y, x = np.unravel_index(int(res.argmax()), res.shape)
+        return (float(res[y, x]), int(x), int(y))
+    
+    coarse = _ncc_map(_downsample(image, f), _downsample(tpl, f))
+    cy, cx = np.unravel_index(int(coarse.argmax()), coarse.shape)
+    
+    # Tinh chỉnh quanh vị trí thô ở độ phân giải gốc
+    y0, x0 = max(0, cy * f - 2 * f), max(0, cx * f - 2 * f)
+    y1, x1 = min(H, cy * f + 2 * f + h), min(W, cx * f + 2 * f + w)
+    res = _ncc_map(image[y0:y1, x0:x1], tpl)
+    y, x = np.unravel_index(int(res.argmax()), res.shape)
+    return (float(res[y, x]), int(x0 + x), int(y0 + y))
+
+def _match_region(frame, tpl, box, min_conf, scale=1.0):
+    """Match template (ở tỉ lệ scale) trong vùng box của frame (None = cả màn hình). Trả về (score, x, y)."""
+    x0, y0, x1, y1 = box or (0, 0, frame.w, frame.h)
+    needle = tpl.scales.get(scale)
+    w, h = (needle.shape[1], needle.shape[0]) if needle is not None else (tpl.w, tpl.h)
+    if h > y1 - y0 or w > x1 - x0:
+        return (0.0, None, None)
+    if cv2 is not None and frame.gray is not None:
+        if box is None and frame.w * frame.h >= TILE_MIN_PIXELS and _parallel_ok(frame):
+            return _match_tiles(frame.gray, needle)
+        res = cv2.matchTemplate(frame.gray[y0:y1, x0:x1], needle, cv2.TM_CCOEFF_NORMED)
+        _, score, _, loc = cv2.minMaxLoc(res)
+        return (float(score), x0 + loc[0] + w // 2, y0 + loc[1] + h // 2)
+    if frame.gray is not None and needle is not None:
+        # Không có OpenCV: NCC bằng NumPy/FFT, cùng thang điểm với TM_CCOEFF_NORMED
+        score, x, y = ncc_match(frame.gray[y0:y1, x0:x1], needle)
+        return (score, x0 + x + w // 2, y0 + y + h // 2) if x is not None else (0.0, None, None)
+    # Không có NumPy: pyscreeze chỉ trả vị trí, không có điểm số
+    if pyautogui is None:
+        return (0.0, None, None)
+    image = frame.image if frame.image is not None else Image.fromarray(frame.gray)
+    haystack = image if box is None else image.crop(box)
+    found = pyautogui.locate(tpl.image, haystack, confidence=min_conf)
+    if found:
+        return (min_conf, x0 + found.left + found.width // 2, y0 + found.top + found.height // 2)
+    return (0.0, None, None)
+
+# ---- Thread pool: matchTemplate/FFT nhả GIL nên chạy song song được trên nhiều core ----
+MATCH_WORKERS = max(2, min(8, os.cpu_count() or 2))
+TILE_MIN_PIXELS = 2560 * 1440  # Màn hình lớn hơn mức này thì chia dải để quét song song
+_MATCH_POOLS = {}
+
+def _match_pool(kind):
+    """Pool riêng cho template và cho dải ảnh (tránh deadlock khi task template chờ task dải)."""
+    if kind not in _MATCH_POOLS:
+        _MATCH_POOLS[kind] = ThreadPoolExecutor(max_workers=MATCH_WORKERS, thread_name_prefix=f"match-{kind}")
+    return _MATCH_POOLS[kind]
+
+def _parallel_ok(frame):
+    # OpenCV và FFT của NumPy đều chạy phần nặng ngoài GIL
+    return frame.gray is not None and MATCH_WORKERS > 1
+
+def _match_tiles(gray, needle):
+    """Chia màn hình thành các dải ngang chồng nhau (đủ cao cho template), match song song. Trả về (score, x, y)."""
+    H, W = gray.shape
+    h, w = needle.shape
+    n = min(MATCH_WORKERS, max(1, H // (h * 4)))
+    step = -(-(H - h + 1) // n)  # Số vị trí đặt template mỗi dải (làm tròn lên)
+    
+    def band(y0):
+        y1 = min(H, y0 + step + h - 1)
+        res = cv2.matchTemplate(gray[y0:y1], needle, cv2.TM_CCOEFF_NORMED)
+        _, score, _, loc = cv2.minMaxLoc(res)
+        return float(score), loc[0], y0 + loc[1]
+    
+    score, x, y = max(_match_pool("tiles").map(band, range(0, H - h + 1, step)))
+    return (score, x + w // 2, y + h // 2)
+
+def _match_at_scale(frame, tpl, scale, min_conf, roi_conf):
+    """
+    Thử vùng quanh vị trí cũ trước (chỉ nhận khi đạt roi_conf), trượt thì quét cả màn hình.
+    Trả về (score, x, y, full).
+    """
+    needle = tpl.scales.get(scale)
+    w, h = (needle.shape[1], needle.shape[0]) if needle is not None else (tpl.w, tpl.h)
+    box = _roi_box(frame, tpl.name, w, h)
+    if box:
+        score, x, y = _match_region(frame, tpl, box, roi_conf, scale)
+        if x is not None and score >= roi_conf:
+            return (score, x, y, False)
+    return _match_region(frame, tpl, None, min_conf, scale) + (True,)
+
+# Số lần khớp liên tiếp ở cùng tỉ lệ để chốt tỉ lệ cho cả phiên (lưu cùng last_hits, xóa khi đổi màn hình)
+SCALE_LOCK_HITS = 3
+SCALE_UNLOCK_MISSES = 30  # Đã chốt mà trượt cả màn hình chừng này lần liên tiếp thì bỏ chốt
+SCALE_SURE_CONF = 0.9  # Chưa chốt: điểm này thì khỏi thử các tỉ lệ còn lại
+
+def _scale_order(tpl):
+    """Chưa chốt: thử tỉ lệ gần với scale DPI của màn hình trước (icon chụp ở 100%)."""
+    try:
+        expected = get_display()["scale"][0]
+    except Exception:
+        expected = 1.0
+    return sorted(tpl.scales, key=lambda sc: abs(sc - expected))
+
+def match_template(frame, img_path, min_conf=0.6, top_conf=None):
+    """
+    Tính bản đồ tương quan MỘT lần cho template trên frame.
+    Thử vùng quanh vị trí khớp lần trước, chỉ quét cả màn hình khi trượt.
+    Điểm khớp quanh vị trí cũ phải đạt top_conf (mức cao nhất của caller, mặc định min_conf):
+    hạ ngưỡng chỉ sau khi đã quét cả màn hình, để vật na ná ở chỗ cũ không thắng nút thật ở chỗ khác.
+    Chỉ match ở tỉ lệ đã chốt cho phiên; chưa chốt thì thử từ tỉ lệ gần scale màn hình nhất,
+    lấy tỉ lệ tốt nhất và bỏ phiếu chốt khi nó đạt top_conf.
+    Trả về (score, x, y) của điểm khớp tốt nhất (tâm, toạ độ vật lý); kết quả được nhớ trong frame.
+    """
+    top_conf = max(min_conf, top_conf or min_conf)
+    cached = frame.scores.get(img_path)
+    if cached and (cached[3] or cached[0] >= top_conf):
+        return cached[:3]
+    
+    result = (0.0, None, None, True)
+    try:
+        tpl = load_template(img_path)
+        locked = _load_last_hits().get("__scale__")
+        scales = [locked] if locked in tpl.scales else _scale_order(tpl)
+        best_scale = scales[0]
+        for sc in scales:
+            res = _match_at_scale(frame, tpl, sc, min_conf, top_conf)
+            if res[1] is not None and res[0] > result[0]:
+                result, best_scale = res, sc
+            if res[0] >= SCALE_SURE_CONF:
+                break
+        
+        score, x, y, full = result
+        hit = x is not None and score >= min_conf
+        if hit:
+            if locked is None and len(scales) > 1 and score >= top_conf and vote_hit_scale(best_scale):
+                remember_hit_scale(best_scale)
+            if full:
+                remember_hit(tpl, x, y)
+        if locked is not None and len(scales) == 1 and (full or hit):
+            note_locked_result(hit)
+    except Exception as e:
+        logging.debug(f"Lỗi match {os.path.basename(img_path)}: {e}")
+    
+    frame.scores[img_path] = result
+    return result[:3]
+
+def match_many(frame, img_paths, min_conf=0.6):
+    """Match song song nhiều template trên cùng frame (kết quả được nhớ trong frame.scores)."""
+    todo = [p for p in img_paths if p not in frame.scores]
+    if len(todo) > 1 and _parallel_ok(frame):
+        list(_match_pool("templates").map(
+            lambda p: match_template(frame, p, template_threshold(p, min_conf)), todo))
+    return {p: match_template(frame, p, template_threshold(p, min_conf)) for p in img_paths}
+
+def find_on_frame(frame, img_paths, confidence=0.85):
+    """
+    Tìm template đầu tiên (theo thứ tự) đạt ngưỡng trên frame. Trả về (img_path, score, Point) hoặc None.
+    Template đã hiệu chỉnh dùng ngưỡng riêng thay cho confidence.
+    """
+    for img_path, (score, x, y) in match_many(frame, img_paths, confidence).items():
+        if x is not None and score >= template_threshold(img_path, confidence):
+            return img_path, score, Point(x, y)
+    return None
+
+def locate_once(img_path, confidence=0.85, frame=None):
+    """Tìm ảnh trên một frame (chụp mới nếu không truyền vào). Trả về Point hoặc None."""
+    try:
+        hit = find_on_frame(frame or grab_frame(), [img_path], confidence)
+    except Exception:
+        return None
+    return hit[2] if hit else None
+
+def _names(img_paths):
+    return ", ".join(os.path.basename(p) for p in img_paths)
+
+@timed
+def wait_any(img_paths, timeout_sec=30, confidence=0.85):
+    """
+    Theo dõi nhiều ảnh cùng lúc trên cùng các frame.
+    Trả về (img_path, Point) của ảnh xuất hiện trước (ưu tiên theo thứ tự truyền vào) hoặc (None, None).
+    """
+    img_paths = list(img_paths)
+    logging.info(f"Chờ một trong: {_names(img_paths)}...")
+    end = time.time() + timeout_sec
+    last_sig = None
+    
+    while time.time() < end:
+        hit = None
+        try:
+            frame = grab_frame()
+            if frame.sig != last_sig:  # Màn hình không đổi -> kết quả match cũng không đổi
+                last_sig = frame.sig
+                span_attempt()
+                hit = find_on_frame(frame, img_paths, confidence)
+        except Exception:
+            pass
+        if hit:
+            img_path, score, pos = hit
+            logging.info(f"✓ Thấy {os.path.basename(img_path)} tại ({pos.x}, {pos.y}) score={score:.2f}")
+            return img_path, pos
+        nap(poll_interval())
+    
+    logging.warning(f"✗ Không thấy: {_names(img_paths)}")
+    return None, None
+
+@timed
+def wait_all(img_paths, timeout_sec=30, confidence=0.85):
+    """
+    Chờ đến khi TẤT CẢ ảnh đã xuất hiện (không cần cùng một frame).
+    Trả về dict {img_path: Point} — thiếu phần tử nghĩa là hết giờ mà ảnh đó chưa xuất hiện.
+    """
+    img_paths = list(img_paths)
+    logging.info(f"Chờ tất cả: {_names(img_paths)}...")
+    found = {}
     end = time.time() + timeout_sec
+    last_sig = None
     
     while time.time() < end:
         try:
-            pos = pyautogui.locateCenterOnScreen(img_path, confidence=confidence)
-            if pos:
-                logging.info(f"✓ Thấy ảnh tại ({pos.x}, {pos.y})")
-                return pos
+            frame = grab_frame()
+            if frame.sig != last_sig:  # Màn hình không đổi -> kết quả match cũng không đổi
+                last_sig = frame.sig
+                pending = [p for p in img_paths if p not in found]
+                span_attempt()
+                for img_path, (score, x, y) in match_many(frame, pending, confidence).items():
+                    if x is not None and score >= template_threshold(img_path, confidence):
+                        found[img_path] = Point(x, y)
         except Exception:
             pass
-        time.sleep(r(*RANDOM.retry_screen_interval))
+        if len(found) == len(img_paths):
+            logging.info(f"✓ Đã thấy đủ: {_names(img_paths)}")
+            return found
+        nap(poll_interval())
     
-    logging.warning(f"✗ Không thấy ảnh: {os.path.basename(img_path)}")
-    return None
+    logging.warning(f"✗ Thiếu: {_names(p for p in img_paths if p not in found)}")
+    return found
+
+@timed
+def wait_image(img_path, timeout_sec=30, confidence=0.85):
+    """Chờ ảnh xuất hiện, trả về vị trí hoặc None."""
+    return wait_any([img_path], timeout_sec=timeout_sec, confidence=confidence)[1]
 
+@timed
 def wait_and_click_image(img_path, timeout_sec=30, confidence=0.85):
-    """Chờ ảnh và click với giảm dần confidence."""
+    """
+    Chờ ảnh và click. Template đã hiệu chỉnh: một ngưỡng duy nhất;
+    chưa hiệu chỉnh: giảm dần confidence (một lần chụp + một lần match cho cả thang).
+    """
     logging.info(f"Chờ + click: {os.path.basename(img_path)}...")
     end = time.time() + timeout_sec
-    levels = [confidence, 0.8, 0.75, 0.7, 0.65, 0.6]
+    calibrated = template_threshold(img_path, None)
+    levels = [calibrated] if calibrated is not None else [confidence] + CONF_LEVELS
+    last_sig = None
     
     while time.time() < end:
-        for conf in levels:
-            try:
-                pos = pyautogui.locateCenterOnScreen(img_path, confidence=conf)
-                if pos:
-                    click_once(pos.x, pos.y)
-                    logging.info(f"✓ Click ảnh tại ({pos.x}, {pos.y}) conf={conf:.2f}")
-                    return True
-            except Exception:
-                pass
-        time.sleep(r(*RANDOM.retry_screen_interval))
+        score, x, y = 0.0, None, None
+        try:
+            frame = grab_frame()
+            if frame.sig != last_sig:
+                last_sig = frame.sig
+                span_attempt()
+                score, x, y = match_template(frame, img_path, min(levels), levels[0])
+        except Exception:
+            pass
+        if x is not None:
+            conf = next((c for c in levels if score >= c), None)
+            if conf is not None:
+                click_once(x, y)
+                logging.info(f"✓ Click ảnh tại ({x}, {y}) conf={conf:.2f}")
+                return True
+        nap(poll_interval())
     
     logging.warning(f"✗ Không click được: {os.path.basename(img_path)}")
     return False
 
+# ================== STEP ENGINE ==================
+# Mỗi bước = hành động + điều kiện sau (ảnh xuất hiện / biến mất / màn hình đổi rồi đứng yên).
+# Thời gian rsleep cũ chỉ còn là TRẦN: điều kiện đúng là đi tiếp ngay.
+STABLE_FRAMES = 2      # Số frame liên tiếp không đổi để coi là màn hình đã ổn định
+STABLE_MIN_SEC = 1.0   # ...và đứng yên tối thiểu chừng này giây (poll nhanh 50–150ms thì 2 frame là quá ngắn)
+
+def _upper(bucket):
+    return getattr(RANDOM, bucket)[1]
+
+@timed
+def wait_until(appear=None, vanish=None, changed_from=None, stable=False, max_sec=5.0, confidence=0.8):
+    """
+    Chờ tới khi điều kiện đúng hoặc hết max_sec. Điều kiện (tất cả phải đúng):
+    - appear: một trong các ảnh xuất hiện
+    - vanish: tất cả các ảnh đã biến mất
+    - changed_from: signature màn hình khác giá trị này
+    - stable: màn hình đứng yên STABLE_FRAMES frame liên tiếp VÀ ít nhất STABLE_MIN_SEC giây
+    Trả về True nếu điều kiện đúng, False nếu hết giờ.
+    """
+    end = time.time() + max_sec
+    last_sig, same, quiet_since = None, 0, time.time()
+    
+    while True:
+        try:
+            frame = grab_frame()
+        except Exception:
+            frame = None
+        if frame is not None:
+            if frame.sig == last_sig:
+                same += 1
+            else:
+                same, quiet_since = 0, frame.ts
+            last_sig = frame.sig
+            ok = True
+            if changed_from is not None and frame.sig == changed_from:
+                ok = False
+            if ok and stable and (same < STABLE_FRAMES or frame.ts - quiet_since < STABLE_MIN_SEC):
+                ok = False
+            if ok and appear and not find_on_frame(frame, list(appear), confidence):
+                ok = False
+            if ok and vanish:
+                scores = match_many(frame, list(vanish), confidence)
+                ok = not any(x is not None and sc >= template_threshold(p, confidence)
+                             for p, (sc, x, y) in scores.items())
+            if ok:
+                return True
+        if time.time() >= end:
+            return False
+        nap(poll_interval())
+
+def screen_sig():
+    """Signature màn hình hiện tại (chụp trước hành động để biết sau đó màn hình có đổi không)."""
+    try:
+        return grab_frame().sig
+    except Exception:
+        return None
+
+def step(action, appear=None, vanish=None, changed=False, bucket="medium", confidence=0.8):
+    """
+    Thực hiện action rồi chờ điều kiện sau tối đa bằng cận trên của bucket rsleep tương ứng.
+    changed=True: chờ màn hình đổi rồi đứng yên.
+    """
+    before = screen_sig() if changed else None
+    action()
+    return wait_until(appear=appear, vanish=vanish, changed_from=before, stable=changed,
+                      max_sec=_upper(bucket), confidence=confidence)
+
+def settle(bucket="medium"):
+    """Chờ màn hình đứng yên (tối đa bằng cận trên của bucket) thay cho rsleep cố định."""
+    return wait_until(stable=True, max_sec=_upper(bucket))
+
+def hotkey_action(*keys):
+    """Action bấm phím/tổ hợp phím cho step()."""
+    return lambda: pyautogui.hotkey(*keys) if len(keys) > 1 else pyautogui.press(keys[0])
+
 # ================== FILE HANDLING ==================
 IMG_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
 
@@ -533,6 +1800,7 @@ def get_required_stats(dir_path):
                     pass
     return (count, total)
 
+@timed
 def ensure_local_folder(code, delete_server=True):
     """Đảm bảo thư mục local có đủ file."""
     local_folder = os.path.join(CFG["LOCAL_DONE_ROOT"], code)
@@ -578,36 +1846,53 @@ def ensure_local_folder(code, delete_server=True):
     
     return True
 
-def cleanup_posted_codes():
-    """Xóa thư mục local của mã đã đăng."""
+def cleanup_posted_codes(rows=None):
+    """
+    Xóa thư mục local của mã đã đăng.
+    Nguồn: journal (mã đã hẹn lịch/đã đăng) + các dòng INPUT đã tải sẵn (không tải lại sheet).
+    """
     logging.info("🧹 Dọn mã đã đăng...")
     try:
-        client = gs_client()
-        ws = client.open(CFG["SPREADSHEET_NAME"]).worksheet(INPUT_SHEET)
-        rows = cached_get_all_values(ws, f"cleanup_{INPUT_SHEET}")
-        
-        for row in rows[1:]:
+        posted = set(journal_codes(STATE_SCHEDULED, STATE_POSTED))
+        for row in (rows or [])[1:]:
             code = row[0].strip() if len(row) > 0 else ""
             status = row[STATUS_COL-1].strip() if len(row) >= STATUS_COL else ""
             if code and status.upper() == "ĐÃ ĐĂNG":
-                folder = os.path.join(CFG["LOCAL_DONE_ROOT"], code)
-                if os.path.isdir(folder):
-                    try:
-                        shutil.rmtree(folder)
-                        logging.info(f"🗑️ Đã xóa: {folder}")
-                    except Exception as e:
-                        logging.warning(f"Không xóa được {folder}: {e}")
+                posted.add(code)
+                if load_checkpoint(code) != STATE_POSTED and journal_get(code):
+                    journal_transition(code, STATE_POSTED)
+        
+        for code in posted:
+            folder = os.path.join(CFG["LOCAL_DONE_ROOT"], code)
+            if os.path.isdir(folder):
+                try:
+                    shutil.rmtree(folder)
+                    logging.info(f"🗑️ Đã xóa: {folder}")
+                except Exception as e:
+                    logging.warning(f"Không xóa được {folder}: {e}")
     except Exception as e:
         logging.warning(f"Lỗi cleanup: {e}")
 
+def prestage_codes(codes):
+    """Copy trước thư mục của các mã chưa hẹn lịch (journal) về local."""
+    for c in codes:
+        if _reached(load_checkpoint(c), STATE_SCHEDULED):
+            continue
+        try:
+            ensure_local_folder(c)
+        except Exception:
+            pass
+
 def find_row_by_code(rows, code):
     for row in rows[1:]:
         if row and len(row) > 0 and norm(row[0]) == code:
             return row
     return None
 
+READY_AHEAD_SEC = 3 * 60 * 60  # Mã lên lịch sau nửa đêm nhưng trong khoảng này cũng đăng luôn
+
 def get_all_ready_codes(rows):
-    """Lấy mã cần đăng hôm nay."""
+    """Lấy mã cần đăng hôm nay (và mã sắp tới giờ đăng trong READY_AHEAD_SEC)."""
     now = datetime.now()
     out = []
     for row in rows[1:]:
@@ -616,7 +1901,7 @@ def get_all_ready_codes(rows):
             t = _parse_time(norm(row[61]) or "")
             if d and t:
                 target = datetime.combine(d, t)
-                if d == now.date() and target > now:
+                if target > now and (d == now.date() or target <= now + timedelta(seconds=READY_AHEAD_SEC)):
                     code = norm(row[0])
                     if code:
                         out.append(code)
@@ -637,77 +1922,114 @@ def get_tomorrow_codes(rows):
 
 # ================== FILE DIALOGS ==================
 def file_dialog_select_first_mp4(target_folder):
-    rsleep("long")
-    
     if wait_and_click_image(icon("FILENAME"), timeout_sec=60, confidence=0.75):
-        rsleep("medium")
+        settle("medium")
     
     pyautogui.hotkey('ctrl', 'l'); rsleep("tiny")
     pyautogui.hotkey('ctrl', 'a'); rsleep("tiny")
     paste_text(target_folder)
-    pyautogui.press('enter'); rsleep("medium")
+    step(hotkey_action('enter'), changed=True, bucket="medium")
     
     pyautogui.keyDown('alt'); pyautogui.press('n'); pyautogui.keyUp('alt'); rsleep("tiny")
     pyautogui.hotkey('ctrl', 'a'); rsleep("tiny")
     paste_text('*.mp4')
-    pyautogui.press('enter'); rsleep("long")
+    step(hotkey_action('enter'), changed=True, bucket="long")
     
     pyautogui.hotkey('shift', 'tab'); rsleep("tiny")
     pyautogui.hotkey('shift', 'tab'); rsleep("tiny")
     pyautogui.press('space'); rsleep("tiny")
     
     for _ in range(2):
-        pyautogui.press('tab'); rsleep("small")
-    pyautogui.press('enter'); rsleep("long")
+        pyautogui.press('tab'); rsleep("tiny")
+    step(hotkey_action('enter'), vanish=[icon("OPEN_READY")], bucket="long")
 
 def file_dialog_select_thumbnail():
-    rsleep("medium")
+    settle("medium")
     pyautogui.hotkey('shift', 'tab'); rsleep("tiny")
     pyautogui.hotkey('shift', 'tab'); rsleep("tiny")
-    pyautogui.press('space'); rsleep("small")
+    pyautogui.press('space'); rsleep("tiny")
     for _ in range(4):
         pyautogui.press('tab'); rsleep("tiny")
-    pyautogui.press('enter'); rsleep("long")
+    step(hotkey_action('enter'), vanish=[icon("OPEN_READY")], bucket="long")
 
 def file_dialog_select_srt():
     if wait_and_click_image(icon("FILENAME"), timeout_sec=60, confidence=0.75):
-        rsleep("small")
+        settle("small")
     
     paste_text('*.srt'); rsleep("tiny")
-    pyautogui.press('enter'); rsleep("small")
+    step(hotkey_action('enter'), changed=True, bucket="small")
     pyautogui.hotkey('shift', 'tab'); rsleep("tiny")
     pyautogui.hotkey('shift', 'tab'); rsleep("tiny")
-    pyautogui.press('space'); rsleep("medium")
+    step(hotkey_action('space'), changed=True, bucket="medium")
     for _ in range(4):
         pyautogui.press('tab'); rsleep("tiny")
-    pyautogui.press('enter'); rsleep("long")
+    step(hotkey_action('enter'), vanish=[icon("OPEN_READY")], bucket="long")
 
 # ================== UPLOAD PROGRESS CHECK ==================
-def wait_for_upload_complete(timeout_minutes=10):
+UPLOAD_POLL_SEC = 5   # Chờ upload 10–30 phút: chụp + match thưa, nhường CPU cho trình duyệt đang tải lên
+UPLOAD_QUIET_SEC = 3 * 60  # Màn hình đứng yên chừng này = % tải lên đã ngừng chạy (không cần template)
+
+@timed
+def wait_for_upload_complete(timeout_minutes=10, max_minutes=30):
     """
-    Chờ video upload xong trước khi tiếp tục.
-    Đơn giản: chờ cứng timeout_minutes phút cho an toàn.
+    Chờ video upload xong trước khi tiếp tục. Chụp màn hình mỗi UPLOAD_POLL_SEC giây:
+    - Có template trạng thái: trả về ngay khi thấy "tải lên xong"/"kiểm tra xong";
+      hết timeout_minutes mà vẫn thấy "đang tải lên" thì chờ thêm tới max_minutes.
+    - Màn hình không đổi suốt UPLOAD_QUIET_SEC (phần trăm tải lên không còn chạy) cũng coi là xong.
+    - Không có tín hiệu nào: chờ tối đa timeout_minutes phút như cũ.
     """
-    logging.info(f"⏳ Chờ {timeout_minutes} phút để đảm bảo video upload xong...")
+    done_icons = [icon(n) for n in ("CHECKS_DONE", "UPLOAD_DONE") if template_available(n)]
+    if not done_icons:
+        logging.info("Chưa có template UPLOAD_DONE/CHECKS_DONE (tạo bằng: python main.py --capture-template NAME x y w h)")
+    uploading_icon = icon("UPLOADING") if template_available("UPLOADING") else None
+    logging.info(f"⏳ Theo dõi trạng thái upload (tối đa {timeout_minutes}–{max_minutes} phút)...")
+    start = time.time()
+    deadline = start + timeout_minutes * 60
+    hard_deadline = start + max_minutes * 60
+    last_sig, quiet_since = None, start
     
-    for minute in range(timeout_minutes):
-        remaining = timeout_minutes - minute
-        logging.info(f"⏳ Còn {remaining} phút...")
-        time.sleep(60)  # Chờ 1 phút
+    while True:
+        hit = None
+        try:
+            frame = grab_frame()
+            if done_icons:
+                hit = find_on_frame(frame, done_icons, 0.8)
+            if frame.sig != last_sig:
+                last_sig, quiet_since = frame.sig, frame.ts
+        except Exception:
+            frame = None
+        if hit:
+            logging.info(f"✅ Upload xong sau {(time.time() - start) / 60:.1f} phút ({os.path.basename(hit[0])})")
+            return True
+        
+        now = time.time()
+        if frame is not None and now - quiet_since >= UPLOAD_QUIET_SEC:
+            logging.info(f"✅ Màn hình đứng yên {UPLOAD_QUIET_SEC // 60} phút → coi như upload xong "
+                         f"(sau {(now - start) / 60:.1f} phút)")
+            return True
+        if now >= hard_deadline:
+            break
+        if now >= deadline:
+            if uploading_icon and locate_once(uploading_icon, confidence=0.8, frame=frame):
+                logging.info("⏳ Vẫn đang tải lên → chờ thêm...")
+                deadline = min(hard_deadline, now + 60)
+            else:
+                break
+        nap(UPLOAD_POLL_SEC)
     
-    logging.info(f"✅ Đã chờ đủ {timeout_minutes} phút, sẵn sàng tiếp tục")
-    return True
+    logging.warning(f"⚠️ Không xác nhận được upload xong sau {(time.time() - start) / 60:.1f} phút, tiếp tục")
+    return False
 
 def safe_fallback_step2():
     """
     Fallback an toàn khi Step 2 lỗi:
-    1. Chờ cứng 10 phút để đảm bảo upload xong
+    1. Chờ upload xong (tối đa 10 phút, lâu hơn nếu vẫn đang tải lên)
     2. F5 refresh
     3. Enter để confirm dialog (nếu có)
     """
     logging.warning("⚠️ Step 2 lỗi - Bắt đầu fallback an toàn...")
     
-    # Chờ cứng 10 phút
+    # Chờ upload xong
     wait_for_upload_complete(timeout_minutes=10)
     
     # F5 refresh
@@ -721,7 +2043,7 @@ def safe_fallback_step2():
         rsleep("medium")
         
         # Chờ thêm cho trang ổn định
-        time.sleep(5)
+        nap(5)
         
         logging.info("✅ Đã F5 + Enter, sẵn sàng tiếp tục")
         return True
@@ -735,6 +2057,7 @@ def press(key, n=1, bucket="tiny"):
     for _ in range(n):
         pyautogui.press(key); rsleep(bucket)
 
+@timed
 def handle_metadata_flow(active_row):
     """Nhập metadata: tiêu đề, mô tả, thumbnail, playlist."""
     title = norm(active_row[IDX_TITLE_BB]) if len(active_row) > IDX_TITLE_BB else ""
@@ -744,16 +2067,15 @@ def handle_metadata_flow(active_row):
     CONF = r(*RANDOM.click_confidence)
     
     logging.info(f"Nhập TIÊU ĐỀ: {title[:50]}...")
-    rsleep("long")
+    # Màn chi tiết đã tải xong (có nút Tiếp) và đứng yên thì mới gõ vào ô tiêu đề
+    if not wait_until(appear=[icon("NEXT_BTN")], stable=True, max_sec=TIMEOUT, confidence=CONF):
+        logging.warning("Chưa thấy màn chi tiết ổn định, vẫn nhập tiêu đề")
     pyautogui.hotkey('ctrl', 'a'); rsleep("tiny")
     paste_text(title or "")
     
     # Check UI thử nghiệm
-    try:
-        test_pos = pyautogui.locateCenterOnScreen(icon("THUNNGHIEM"), confidence=0.80)
-        tab_count = 3 if test_pos else 2
-    except Exception:
-        tab_count = 2
+    test_pos = locate_once(icon("THUNNGHIEM"), confidence=0.80)
+    tab_count = 3 if test_pos else 2
     
     press('tab', tab_count, "tiny")
     rsleep("small")
@@ -767,32 +2089,34 @@ def handle_metadata_flow(active_row):
     rsleep("small")
     
     # Cuộn xuống + chọn thumbnail
-    press('end', 2, "small")
-    rsleep("medium")
-    pyautogui.press('enter'); rsleep("small")
+    press('end', 2, "tiny")
+    settle("medium")
+    step(hotkey_action('enter'), appear=[icon("OPEN_READY")], bucket="small", confidence=CONF)
     
     if wait_image(icon("OPEN_READY"), timeout_sec=TIMEOUT, confidence=CONF):
         file_dialog_select_thumbnail()
     else:
         logging.error("Không thấy hộp thoại Open thumbnail")
-        return
+        return False
     
     # Chọn playlist
     pos_dsp = wait_image(icon("DANHSACHPHAT"), timeout_sec=TIMEOUT, confidence=CONF)
     if pos_dsp:
-        move_click(pos_dsp.x, pos_dsp.y); rsleep("small")
+        step(lambda: move_click(pos_dsp.x, pos_dsp.y), changed=True, bucket="small")
         pyautogui.press('tab'); rsleep("tiny")
-        pyautogui.press('enter'); rsleep("small")
+        step(hotkey_action('enter'), changed=True, bucket="small")
         press('tab', 2, "tiny")
-        pyautogui.press('enter'); rsleep("small")
+        step(hotkey_action('enter'), changed=True, bucket="small")
     
     # Click Tiếp
     pos = wait_image(icon("NEXT_BTN"), timeout_sec=TIMEOUT, confidence=CONF)
     if pos:
         click_once(pos.x, pos.y)
-    else:
-        logging.warning("Không thấy nút Tiếp")
+        return True
+    logging.warning("Không thấy nút Tiếp")
+    return False
 
+@timed
 def handle_step2_flow(active_row):
     """Step 2: phụ đề, end screen, thẻ."""
     TIMEOUT = int(r(*RANDOM.click_timeout_sec))
@@ -801,12 +2125,11 @@ def handle_step2_flow(active_row):
     
     # Vào Bước 2
     logging.info("Vào Bước 2...")
-    pos_buoc2 = wait_image(icon("BUOC2"), timeout_sec=STEP2_TIMEOUT, confidence=CONF)
+    step2_icons = [icon("BUOC2"), icon("STEP2_THEM")]
+    _, pos_buoc2 = wait_any(step2_icons, timeout_sec=STEP2_TIMEOUT, confidence=CONF)
     if not pos_buoc2:
-        pos_buoc2 = wait_image(icon("STEP2_THEM"), timeout_sec=30, confidence=CONF)
-        if not pos_buoc2:
-            logging.error("Không vào được Bước 2")
-            return False
+        logging.error("Không vào được Bước 2")
+        return False
     
     # Click và chờ taiteplen.png
     for attempt in range(5):
@@ -817,40 +2140,31 @@ def handle_step2_flow(active_row):
         if wait_image(icon("TAITEPLEN"), timeout_sec=10, confidence=CONF):
             break
         
-        pos_buoc2 = wait_image(icon("BUOC2"), timeout_sec=15, confidence=CONF) or \
-                    wait_image(icon("STEP2_THEM"), timeout_sec=5, confidence=CONF)
+        _, pos_buoc2 = wait_any(step2_icons, timeout_sec=15, confidence=CONF)
         if not pos_buoc2:
             return False
     else:
         return False
     
-    # Click taiteplen với retry
-    time.sleep(15)
+    # Click taiteplen với retry (chờ tối đa 15s mỗi lượt, đi tiếp ngay khi thấy TIEPTUC)
+    nap(15)  # Nút hiện trước khi bấm được: giữ nguyên thời gian chờ cũ
     for attempt in range(3):
-        for conf in [CONF, 0.80, 0.75, 0.70]:
-            try:
-                pos = pyautogui.locateCenterOnScreen(icon("TAITEPLEN"), confidence=conf)
-                if pos:
-                    move_click(pos.x, pos.y)
-                    break
-            except Exception:
-                pass
+        pos = locate_once(icon("TAITEPLEN"), confidence=min(CONF, 0.70))
+        if pos:
+            move_click(pos.x, pos.y)
         
-        time.sleep(15)
-        try:
-            if pyautogui.locateCenterOnScreen(icon("TIEPTUC"), confidence=0.70):
-                break
-        except Exception:
-            pass
+        seen, _ = wait_any([icon("TIEPTUC")], timeout_sec=15, confidence=0.70)
+        if seen:
+            break
     else:
         return False
     
     # Click tieptuc
     if not wait_and_click_image(icon("TIEPTUC"), timeout_sec=STEP2_TIMEOUT, confidence=CONF):
         press('tab', 3, "tiny")
-        pyautogui.press('enter'); rsleep("long")
+        step(hotkey_action('enter'), appear=[icon("OPEN_READY")], bucket="long", confidence=CONF)
     else:
-        rsleep("long")
+        wait_until(appear=[icon("OPEN_READY")], max_sec=_upper("long"), confidence=CONF)
     
     # Chọn SRT
     if not wait_image(icon("OPEN_READY"), timeout_sec=STEP2_TIMEOUT, confidence=CONF):
@@ -861,17 +2175,16 @@ def handle_step2_flow(active_row):
     pos_done = wait_image(icon("DONE"), timeout_sec=STEP2_TIMEOUT, confidence=CONF)
     if not pos_done:
         return False
-    rsleep("medium")
-    move_click(pos_done.x, pos_done.y); rsleep("medium")
+    settle("medium")
+    step(lambda: move_click(pos_done.x, pos_done.y), vanish=[icon("DONE")], bucket="medium", confidence=CONF)
     
     # End screen
     if not wait_image(icon("ENDSCREEN"), timeout_sec=STEP2_TIMEOUT, confidence=CONF):
         return False
     
     press('tab', 2, "tiny")
-    pyautogui.press('enter'); rsleep("medium")
-    
-    rsleep("medium")
+    step(hotkey_action('enter'), appear=[icon("CHON_ENDSCREEN")], bucket="medium", confidence=CONF)
+    settle("medium")
     if not wait_and_click_image(icon("CHON_ENDSCREEN"), timeout_sec=STEP2_TIMEOUT, confidence=CONF):
         return False
     
@@ -887,21 +2200,21 @@ def handle_step2_flow(active_row):
     
     pos_dangky = wait_image(icon("DANGKY"), timeout_sec=STEP2_TIMEOUT, confidence=CONF)
     if pos_dangky:
-        move_click(pos_dangky.x, pos_dangky.y); rsleep("small")
+        step(lambda: move_click(pos_dangky.x, pos_dangky.y), changed=True, bucket="small")
     
     # Lưu end screen
     pos_save = wait_image(icon("SAVE"), timeout_sec=STEP2_TIMEOUT, confidence=CONF)
     if not pos_save:
         return False
-    move_click(pos_save.x, pos_save.y); rsleep("medium")
+    step(lambda: move_click(pos_save.x, pos_save.y), appear=[icon("KETTHUC_OK")], bucket="medium", confidence=CONF)
     
     # Thêm thẻ (Cards)
     if not wait_image(icon("KETTHUC_OK"), timeout_sec=STEP2_TIMEOUT, confidence=CONF):
         return False
     
-    rsleep("small")
+    settle("small")
     press('tab', 1, "tiny")
-    pyautogui.press('enter'); rsleep("small")
+    step(hotkey_action('enter'), changed=True, bucket="small")
     
     def click_the_button():
         try:
@@ -928,10 +2241,9 @@ def handle_step2_flow(active_row):
     # Thêm playlist card
     if click_the_button():
         press('tab', 4, "tiny")
-        pyautogui.press('enter'); rsleep("small")
-        rsleep("small")
+        step(hotkey_action('enter'), changed=True, bucket="medium")
         press('tab', 3, "tiny")
-        pyautogui.press('enter'); rsleep("medium")
+        step(hotkey_action('enter'), changed=True, bucket="medium")
     
     # Thêm video cards (BD, BE, BF, BG)
     video_ok = []
@@ -945,8 +2257,7 @@ def handle_step2_flow(active_row):
         
         rsleep("tiny")
         press('tab', 1, "tiny")
-        pyautogui.press('enter'); rsleep("medium")
-        rsleep("small")
+        step(hotkey_action('enter'), appear=[icon("CHONVIDEO_CUTHE")], bucket="medium", confidence=CONF)
         
         pos_choose = wait_image(icon("CHONVIDEO_CUTHE"), timeout_sec=STEP2_TIMEOUT, confidence=CONF)
         if not pos_choose:
@@ -958,9 +2269,10 @@ def handle_step2_flow(active_row):
         
         pos_tag = wait_image(icon("TAGVIDEO"), timeout_sec=STEP2_TIMEOUT, confidence=CONF)
         if pos_tag:
-            click_once(pos_tag.x, pos_tag.y)
+            step(lambda: click_once(pos_tag.x, pos_tag.y), vanish=[icon("TAGVIDEO")], bucket="medium", confidence=CONF)
             video_ok.append(col_name)
-        rsleep("medium")
+        else:
+            settle("medium")
     
     if not video_ok:
         return False
@@ -975,49 +2287,50 @@ def handle_step2_flow(active_row):
     # Lưu thẻ
     pos_save = wait_image(icon("SAVE"), timeout_sec=STEP2_TIMEOUT, confidence=CONF)
     if pos_save:
-        move_click(pos_save.x, pos_save.y); rsleep("medium")
+        step(lambda: move_click(pos_save.x, pos_save.y), changed=True, bucket="medium")
     
     logging.info("Step 2 hoàn thành")
     return True
 
-def handle_step3_4_flow(active_row, client, code):
+@timed
+def handle_step3_4_flow(active_row, code):
     """Step 3-4: hẹn lịch và đăng."""
     TIMEOUT = int(r(*RANDOM.click_timeout_sec))
     
     # Click Chế độ hiển thị
     if not wait_and_click_image(icon("CHEDO_HIEN_THI"), timeout_sec=TIMEOUT):
         return False
-    rsleep("medium")
+    settle("medium")
     
     # Click Hẹn lịch
     if not wait_and_click_image(icon("HENLICH"), timeout_sec=TIMEOUT):
         return False
-    rsleep("medium")
+    settle("medium")
     
     press('tab', 8, "tiny")
-    pyautogui.press('enter'); rsleep("small")
+    step(hotkey_action('enter'), changed=True, bucket="small")
     
     # Dán ngày
     date_val = norm(active_row[IDX_DATE_BI]) if len(active_row) > IDX_DATE_BI else ""
     pyautogui.hotkey('ctrl', 'a'); rsleep("tiny")
     paste_text(date_val or "")
-    pyautogui.press('enter'); rsleep("small")
+    step(hotkey_action('enter'), changed=True, bucket="small")
     
     # Dán giờ
     time_val = norm(active_row[IDX_TIME_BJ]) if len(active_row) > IDX_TIME_BJ else ""
     pos_time = wait_image(icon("TIME"), timeout_sec=TIMEOUT)
     if not pos_time:
         return False
-    move_click(pos_time.x, pos_time.y); rsleep("small")
+    step(lambda: move_click(pos_time.x, pos_time.y), changed=True, bucket="small")
     pyautogui.hotkey('ctrl', 'a'); rsleep("tiny")
     paste_text(time_val or "")
-    pyautogui.press('enter'); rsleep("small")
+    step(hotkey_action('enter'), changed=True, bucket="small")
     
     # Click Lên lịch
     pos_publish = wait_image(icon("SCHEDULE_PUBLISH"), timeout_sec=TIMEOUT)
     if not pos_publish:
         return False
-    move_click(pos_publish.x, pos_publish.y); rsleep("medium")
+    step(lambda: move_click(pos_publish.x, pos_publish.y), vanish=[icon("SCHEDULE_PUBLISH")], bucket="medium")
     
     # Xử lý popup Đã hiểu
     try:
@@ -1028,16 +2341,858 @@ def handle_step3_4_flow(active_row, client, code):
     
     # Cập nhật trạng thái
     try:
-        update_source_status(client, code, "ĐÃ ĐĂNG")
+        publish_status(code, "ĐÃ ĐĂNG")
     except Exception as e:
         logging.warning(f"Lỗi update status: {e}")
     
-    # Đợi 10 phút
-    logging.info("⏳ Đợi 10 phút...")
-    time.sleep(10 * 60)
+    # Thời gian chờ xử lý (10 phút) chạy song song với mã kế tiếp, xem wait_settling()
+    return True
+
+# ================== PIPELINE ==================
+SETTLE_SEC = 10 * 60          # Sau khi lên lịch, để tab của mã đó yên 10 phút cho YouTube xử lý
+PIPELINE_MAX_SETTLING = 3     # Số tab đang chờ xử lý tối đa trước khi mở mã mới
+
+def wait_settling(settling, max_pending=0):
+    """
+    Chờ tới khi số mã còn trong thời gian xử lý <= max_pending.
+    settling: {code: thời điểm hết chờ}; mã đã xong được xóa khỏi dict.
+    """
+    while True:
+        now = time.time()
+        for code in [c for c, t in settling.items() if t <= now]:
+            settling.pop(code)
+            logging.info(f"✅ {code}: đã đủ thời gian xử lý")
+        if len(settling) <= max_pending:
+            return
+        code, until = min(settling.items(), key=lambda kv: kv[1])
+        logging.info(f"⏳ Đợi {code} xử lý thêm {int(until - now)}s ({len(settling)} tab đang chờ)...")
+        nap(max(1, until - now))
+
+# ================== JOB JOURNAL (SQLite) ==================
+# Nhật ký cục bộ theo mã: trạng thái, số lần thử, lỗi cuối, thời gian — còn nguyên qua restart/os.execv
+JOURNAL_PATH = os.path.join(CFG["SCRIPT_DIR"], "journal.db")
+_JOURNAL = {}
+_JOURNAL_LOCK = threading.RLock()
+
+_JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    code TEXT PRIMARY KEY,
+    channel TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    video_id TEXT
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    code TEXT NOT NULL,
+    from_state TEXT,
+    to_state TEXT NOT NULL,
+    at REAL NOT NULL,
+    elapsed_sec REAL
+);
+CREATE TABLE IF NOT EXISTS status_queue (
+    sheet TEXT NOT NULL,
+    code TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    queued_at REAL NOT NULL,
+    written_at REAL,
+    PRIMARY KEY (sheet, code)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    key TEXT PRIMARY KEY,
+    sheet TEXT NOT NULL,
+    modified TEXT,
+    data BLOB NOT NULL,
+    saved_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs(state);
+CREATE INDEX IF NOT EXISTS idx_transitions_code ON transitions(code);
+"""
+
+def journal():
+    """Kết nối SQLite dùng chung (tạo bảng nếu chưa có)."""
+    with _JOURNAL_LOCK:
+        if "conn" not in _JOURNAL:
+            conn = sqlite3.connect(JOURNAL_PATH, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_JOURNAL_SCHEMA)
+            # journal.db cũ (trước khi có video_id)
+            if "video_id" not in {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}:
+                conn.execute("ALTER TABLE jobs ADD COLUMN video_id TEXT")
+            _JOURNAL["conn"] = conn
+        return _JOURNAL["conn"]
+
+def _journal_exec(sql, params=()):
+    with _JOURNAL_LOCK:
+        return journal().execute(sql, params)
+
+def journal_get(code):
+    """Bản ghi của mã (dict) hoặc None."""
+    row = _journal_exec("SELECT * FROM jobs WHERE code = ?", (code,)).fetchone()
+    return dict(row) if row else None
+
+def journal_codes(*states):
+    """Danh sách mã đang ở một trong các trạng thái."""
+    marks = ",".join("?" * len(states))
+    return [r["code"] for r in _journal_exec(f"SELECT code FROM jobs WHERE state IN ({marks})", states)]
+
+def journal_transition(code, state, error=None):
+    """Ghi chuyển trạng thái của mã (tạo bản ghi nếu chưa có)."""
+    now = time.time()
+    with _JOURNAL_LOCK:
+        job = journal_get(code)
+        if job is None:
+            _journal_exec("INSERT INTO jobs (code, channel, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                          (code, CFG["CHANNEL_CODE"], state, now, now))
+            prev_state, prev_at = None, None
+        else:
+            prev_state = job["state"]
+            prev_at = _journal_exec("SELECT MAX(at) FROM transitions WHERE code = ?", (code,)).fetchone()[0]
+        finished = now if state == STATE_SCHEDULED else None
+        _journal_exec("UPDATE jobs SET state = ?, updated_at = ?, last_error = COALESCE(?, last_error), "
+                      "finished_at = COALESCE(?, finished_at) WHERE code = ?",
+                      (state, now, error, finished, code))
+        if prev_state != state:
+            _journal_exec("INSERT INTO transitions (code, from_state, to_state, at, elapsed_sec) VALUES (?, ?, ?, ?, ?)",
+                          (code, prev_state, state, now, (now - prev_at) if prev_at else None))
+
+def journal_attempt(code):
+    """Bắt đầu một lần thử cho mã: tăng attempts, ghi started_at."""
+    with _JOURNAL_LOCK:
+        if journal_get(code) is None:
+            journal_transition(code, STATE_NEW)
+        _journal_exec("UPDATE jobs SET attempts = attempts + 1, started_at = ?, updated_at = ? WHERE code = ?",
+                      (time.time(), time.time(), code))
+
+def journal_error(code, error):
+    """Ghi lỗi cuối của mã (giữ nguyên trạng thái đã hoàn thành)."""
+    with _JOURNAL_LOCK:
+        if journal_get(code) is None:
+            journal_transition(code, STATE_NEW)
+        _journal_exec("UPDATE jobs SET last_error = ?, updated_at = ? WHERE code = ?", (str(error)[:500], time.time(), code))
+
+def journal_video_id(code, video_id):
+    """Ghi ID video YouTube của bản nháp (đọc từ URL hộp thoại upload)."""
+    with _JOURNAL_LOCK:
+        if journal_get(code) is None:
+            journal_transition(code, STATE_NEW)
+        _journal_exec("UPDATE jobs SET video_id = ?, updated_at = ? WHERE code = ?", (video_id, time.time(), code))
+
+def journal_durations(limit=50):
+    """Thời gian (giây) từ lúc bắt đầu lần thử cuối tới lúc hẹn lịch xong của các mã gần nhất."""
+    rows = _journal_exec("SELECT finished_at - started_at AS d FROM jobs WHERE finished_at IS NOT NULL "
+                         "AND started_at IS NOT NULL AND finished_at > started_at ORDER BY finished_at DESC LIMIT ?",
+                         (limit,))
+    return [r["d"] for r in rows]
+
+# ================== UPLOAD STATE MACHINE ==================
+# Trạng thái của một mã, theo thứ tự. Checkpoint = trạng thái cuối đã HOÀN THÀNH, lưu qua các lần chạy.
+STATE_NEW = "NEW"                      # Chưa làm gì
+STATE_FILE_SELECTED = "FILE_SELECTED"  # Đã chọn file -> YouTube đã có bản nháp
+STATE_METADATA = "METADATA"            # Đã nhập tiêu đề/mô tả/thumbnail/playlist
+STATE_STEP2 = "STEP2"                  # Đã qua phụ đề/end screen/thẻ
+STATE_SCHEDULED = "SCHEDULED"          # Đã hẹn lịch
+STATE_POSTED = "POSTED"                # Sheet đã ghi ĐÃ ĐĂNG, thư mục local đã dọn
+UPLOAD_STATES = [STATE_NEW, STATE_FILE_SELECTED, STATE_METADATA, STATE_STEP2, STATE_SCHEDULED, STATE_POSTED]
+
+def load_checkpoint(code):
+    """Trạng thái đã hoàn thành của mã (STATE_NEW nếu chưa có trong journal)."""
+    job = journal_get(code)
+    return job["state"] if job else STATE_NEW
+
+def save_checkpoint(code, state):
+    journal_transition(code, state)
+    logging.info(f"📍 {code}: checkpoint {state}")
+
+def _reached(state, target):
+    return UPLOAD_STATES.index(state) >= UPLOAD_STATES.index(target)
+
+def _open_url(url, appear, TIMEOUT, CONF):
+    pyautogui.hotkey('ctrl', 'l'); rsleep("tiny")
+    paste_text(url)
+    step(hotkey_action('enter'), appear=appear, changed=True, bucket="medium", confidence=CONF)
+    
+    # Phóng to
+    try:
+        pyautogui.keyDown('alt'); pyautogui.press('space'); pyautogui.keyUp('alt'); rsleep("tiny")
+        pyautogui.press('x'); rsleep("small")
+    except Exception:
+        pass
+
+def start_new_upload(code, TIMEOUT, CONF):
+    """Mở trang upload, chọn file mp4. Trả về True khi đã tới màn nhập metadata."""
+    target_folder = FOLDER_PATTERN.format(code=code)
+    _open_url(UPLOAD_URL, [icon("SELECT_BTN")], TIMEOUT, CONF)
+    step(hotkey_action('f5'), appear=[icon("SELECT_BTN")], changed=True, bucket="medium", confidence=CONF)
+    
+    # Click Select files
+    if not wait_and_click_image(icon("SELECT_BTN"), timeout_sec=TIMEOUT, confidence=CONF):
+        step(hotkey_action('f5'), appear=[icon("SELECT_BTN")], changed=True, bucket="medium", confidence=CONF)
+        if not wait_and_click_image(icon("SELECT_BTN"), timeout_sec=60, confidence=CONF):
+            return False
+    
+    # Chọn video
+    if not wait_image(icon("OPEN_READY"), timeout_sec=TIMEOUT, confidence=CONF):
+        return False
+    file_dialog_select_first_mp4(target_folder)
+    
+    # Metadata
+    if not wait_image(icon("NEXT_BTN"), timeout_sec=TIMEOUT, confidence=CONF):
+        return False
+    
+    # Nhớ ID video để lần sau mở lại đúng bản nháp này (không cần tìm trong danh sách)
+    video_id = read_upload_video_id()
+    journal_video_id(code, video_id)  # None: xóa ID của bản nháp cũ (nếu có)
+    if video_id:
+        logging.info(f"🆔 {code}: video {video_id}")
+    else:
+        logging.warning(f"{code}: không đọc được ID video từ URL")
+    return True
+
+def read_upload_video_id():
+    """
+    ID video của hộp thoại upload, đọc từ thanh địa chỉ (…/videos/upload?d=ud&udvid=<id>).
+    F6 trả focus về trang -> ô tiêu đề vẫn được focus như trước.
+    """
+    pyautogui.hotkey('ctrl', 'l'); rsleep("tiny")
+    url = _read_focused_text()
+    pyautogui.press('f6'); rsleep("tiny")
+    m = VIDEO_ID_RE.search(url)
+    return m.group(1) if m else None
+
+def _draft_mp4_name(code):
+    """Tên (không đuôi) của mp4 mà file dialog chọn cho mã — cũng là tiêu đề mặc định của bản nháp."""
+    folder = FOLDER_PATTERN.format(code=code)
+    try:
+        mp4s = sorted(f for f in os.listdir(folder) if f.lower().endswith(".mp4"))
+    except OSError:
+        return None
+    return os.path.splitext(mp4s[0])[0] if mp4s else None
+
+def _content_search_url(query):
+    """Danh sách video trong Studio, lọc theo tiêu đề (channel/UC = kênh đang đăng nhập)."""
+    flt = json.dumps([{"name": "TITLE", "value": query}], ensure_ascii=False, separators=(",", ":"))
+    return f"{STUDIO_CONTENT_URL}?filter={quote(flt)}"
+
+def _read_focused_text():
+    """Copy nội dung ô đang focus (ctrl+a, ctrl+c) mà không sửa gì."""
+    pyperclip.copy("")
+    pyautogui.hotkey('ctrl', 'a'); rsleep("tiny")
+    pyautogui.hotkey('ctrl', 'c'); rsleep("tiny")
+    return (pyperclip.paste() or "").strip()
+
+def reopen_draft(code, state, active_row, TIMEOUT, CONF):
+    """
+    Mở lại bản nháp CỦA MÃ NÀY: theo ID video đã lưu trong journal (studio.youtube.com/video/<id>/edit);
+    chưa có ID thì lọc danh sách video theo tiêu đề (tiêu đề sheet nếu đã qua METADATA — YouTube đã tự lưu,
+    ngược lại tên mp4) rồi bấm "Chỉnh sửa bản nháp".
+    Sau đó đối chiếu ô tiêu đề trên màn chi tiết với tên mp4 / tiêu đề trong sheet.
+    Trả về True khi đã về màn nhập metadata đúng bản nháp; sai hoặc không chắc -> False (upload lại).
+    """
+    mp4_name = _draft_mp4_name(code)
+    title = norm(active_row[IDX_TITLE_BB]) if len(active_row) > IDX_TITLE_BB else ""
+    video_id = (journal_get(code) or {}).get("video_id")
+    
+    if video_id:
+        logging.info(f"↩️ {code}: mở bản nháp {video_id}...")
+        _open_url(STUDIO_EDIT_URL.format(video_id=video_id), [icon("NEXT_BTN")], TIMEOUT, CONF)
+    else:
+        query = title if _reached(state, STATE_METADATA) else mp4_name
+        if not query:
+            return False
+        if not template_available("DRAFT_EDIT"):
+            logging.warning(f"{code}: chưa lưu ID video và chưa có icon DRAFT_EDIT, không mở lại được bản nháp")
+            return False
+        logging.info(f"↩️ {code}: tìm bản nháp '{query[:60]}'...")
+        _open_url(_content_search_url(query), [icon("DRAFT_EDIT")], TIMEOUT, CONF)
+        if not wait_and_click_image(icon("DRAFT_EDIT"), timeout_sec=TIMEOUT, confidence=CONF):
+            return False
+    if not wait_until(appear=[icon("NEXT_BTN")], stable=True, max_sec=TIMEOUT, confidence=CONF):
+        return False
+    
+    current = _read_focused_text()
+    expected = {t for t in (mp4_name, title) if t}
+    if current not in expected and code not in current:
+        logging.warning(f"{code}: bản nháp mở ra có tiêu đề '{current[:60]}' — không phải của mã này")
+        return False
+    return True
+
+@timed
+def run_upload(code, active_row, TIMEOUT, CONF):
+    """
+    Chạy flow của một mã như state machine: chọn file → metadata → step 2 → hẹn lịch.
+    Tiếp tục từ checkpoint: đã có bản nháp thì mở lại bản nháp thay vì upload lại file.
+    Trả về True nếu đã hẹn lịch.
+    """
+    state = load_checkpoint(code)
+    if _reached(state, STATE_FILE_SELECTED) and reopen_draft(code, state, active_row, TIMEOUT, CONF):
+        logging.info(f"↩️ {code}: tiếp tục sau bước {state}")
+    else:
+        if state != STATE_NEW:
+            logging.warning(f"{code}: không mở lại được bản nháp → upload lại từ đầu")
+            state = STATE_NEW
+        if not start_new_upload(code, TIMEOUT, CONF):
+            return False
+        state = STATE_FILE_SELECTED
+        save_checkpoint(code, state)
+    
+    # Metadata (bản nháp mở lại luôn về màn metadata)
+    if not _reached(state, STATE_METADATA):
+        if handle_metadata_flow(active_row):
+            state = STATE_METADATA
+            save_checkpoint(code, state)
+    elif not wait_and_click_image(icon("NEXT_BTN"), timeout_sec=TIMEOUT, confidence=CONF):
+        return False
+    
+    # Step 2
+    if not _reached(state, STATE_STEP2):
+        if not handle_step2_flow(active_row):
+            # Fallback an toàn: chờ upload xong rồi mới F5
+            safe_fallback_step2()
+        elif _reached(state, STATE_METADATA):
+            save_checkpoint(code, STATE_STEP2)
+    
+    # Step 3-4
+    if not handle_step3_4_flow(active_row, code):
+        return False
+    save_checkpoint(code, STATE_SCHEDULED)
+    return True
+
+# ================== SCHEDULER ==================
+# Thay cho nghỉ cứng 3 tiếng: thức dậy kịp để đăng xong trước giờ lên lịch của từng mã
+DEFAULT_UPLOAD_SEC = 60 * 60   # Thời gian một mã khi journal chưa có số liệu
+UPLOAD_TIME_SAFETY = 2.0       # Nhân thời gian đo được cho an toàn
+MIN_LEAD_SEC = 60 * 60         # Bắt đầu trước giờ đăng ít nhất chừng này
+MIN_IDLE_SEC = 10 * 60         # Nghỉ tối thiểu giữa hai vòng
+MAX_IDLE_SEC = 3 * 60 * 60     # Nghỉ tối đa (như trước)
+CHANGE_CHECK_SEC = 15 * 60     # Giữa hai lần thức: chỉ kiểm tra sheet có đổi không (1 call metadata)
+WAKE_MAX_ATTEMPTS = 3          # Mã lỗi quá số lần này thì không thức dậy sớm riêng cho nó nữa
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+
+def expected_upload_sec():
+    """Thời gian đăng một mã ước lượng từ journal (trung vị), hoặc DEFAULT_UPLOAD_SEC."""
+    durations = sorted(journal_durations())
+    return durations[len(durations) // 2] if durations else DEFAULT_UPLOAD_SEC
+
+def upcoming_deadlines(rows):
+    """Hàng đợi ưu tiên (heap) các (giờ đăng, mã) của kênh này, chưa tới giờ và chưa hẹn lịch."""
+    now = datetime.now()
+    heap = []
+    for row in rows[1:]:
+        if len(row) > IDX_TIME_BJ and norm(row[34]) == CFG["CHANNEL_CODE"] and norm(row[47]) == STATUS_OK:
+            d = _parse_date(norm(row[IDX_DATE_BI]) or "")
+            t = _parse_time(norm(row[IDX_TIME_BJ]) or "")
+            code = norm(row[0])
+            if d and t and code:
+                target = datetime.combine(d, t)
+                job = journal_get(code) or {"state": STATE_NEW, "attempts": 0}
+                if target > now and not _reached(job["state"], STATE_SCHEDULED) \
+                        and job["attempts"] < WAKE_MAX_ATTEMPTS:
+                    heapq.heappush(heap, (target.timestamp(), code))
+    return heap
+
+def next_wake_time(rows, cycle_end):
+    """Thời điểm cần chạy vòng kế tiếp, trong khoảng [cycle_end + MIN_IDLE_SEC, cycle_end + MAX_IDLE_SEC]."""
+    lead = max(MIN_LEAD_SEC, expected_upload_sec() * UPLOAD_TIME_SAFETY)
+    wake = cycle_end + MAX_IDLE_SEC
+    heap = upcoming_deadlines(rows)
+    if heap:
+        deadline, code = heap[0]
+        wake = min(wake, deadline - lead)
+        logging.info(f"📅 Mã gần nhất: {code} lúc {datetime.fromtimestamp(deadline):%d/%m %H:%M} "
+                     f"(cần ~{lead / 60:.0f} phút), {len(heap)} mã đang chờ")
+    return max(wake, cycle_end + MIN_IDLE_SEC)
+
+def sheet_modified_time():
+    """modifiedTime của spreadsheet trên Drive (1 call metadata rẻ), None nếu lỗi."""
+    try:
+        if SHEETS_LOCAL_DIR:
+            return gs_spreadsheet().modified_time()
+        sheet_id = gs_spreadsheet().id
+        client = gs_client()
+        http = getattr(client, "http_client", client)
+        resp = retry_api_call(lambda: http.request("get", f"{DRIVE_FILES_URL}/{sheet_id}",
+                                                   params={"fields": "modifiedTime", "supportsAllDrives": True}))
+        return resp.json().get("modifiedTime")
+    except Exception as e:
+        logging.debug(f"Không lấy được modifiedTime: {e}")
+        return None
+
+def data_version():
+    """Dấu hiệu dữ liệu đổi: version của coordinator (worker) hoặc modifiedTime của sheet."""
+    return coordinator_version() if COORDINATOR_URL else sheet_modified_time()
+
+def sleep_until_next_run():
+    """Ngủ tới lần chạy kế tiếp; giữa chừng chỉ kiểm tra sheet có đổi không để tính lại lịch."""
+    cycle_end = time.time()
+    rows = load_input_rows()
+    wake = next_wake_time(rows, cycle_end)
+    last_mod = data_version()
+    logging.info(f"💤 Nghỉ tới {datetime.fromtimestamp(wake):%d/%m %H:%M}")
+    
+    while True:
+        now = time.time()
+        if now >= wake:
+            return
+        nap(min(CHANGE_CHECK_SEC, wake - now))
+        if time.time() >= wake:
+            return
+        
+        mod = data_version()
+        if mod and mod != last_mod:
+            last_mod = mod
+            logging.info("📝 Sheet vừa thay đổi → tính lại lịch")
+            invalidate_cache()
+            rows = load_input_rows()
+            new_wake = next_wake_time(rows, cycle_end)
+            if new_wake != wake:
+                wake = new_wake
+                logging.info(f"💤 Nghỉ tới {datetime.fromtimestamp(wake):%d/%m %H:%M}")
+
+# ================== COORDINATOR / WORKER ==================
+# Coordinator: đọc sheet MỘT lần cho mọi máy, chia việc theo kênh, nhận báo cáo và ghi trạng thái theo lô.
+#   python main.py --coordinator
+# Worker: đặt coordinator_url để lấy dòng INPUT của kênh mình từ coordinator thay vì tải cả sheet.
+# Cấu hình riêng từng máy nằm trong local.json (auto-update không ghi đè) hoặc biến môi trường:
+#   {"coordinator_url": "http://192.168.1.10:8765", "coordinator_bind": "0.0.0.0:8765", "coordinator_secret": "..."}
+#   UPLOAD_COORDINATOR_URL / UPLOAD_COORDINATOR_BIND / UPLOAD_COORDINATOR_SECRET (ưu tiên hơn file)
+LOCAL_CONFIG_PATH = os.path.join(CFG["SCRIPT_DIR"], "local.json")
+
+def load_local_config():
+    try:
+        with open(LOCAL_CONFIG_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.warning(f"Không đọc được {LOCAL_CONFIG_PATH}: {e}")
+        return {}
+
+def local_setting(name, default=""):
+    """Giá trị cấu hình: biến môi trường UPLOAD_<NAME> > local.json > mặc định."""
+    return os.environ.get(f"UPLOAD_{name.upper()}") or load_local_config().get(name) or default
+
+def _parse_bind(value):
+    host, _, port = value.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+COORDINATOR_URL = local_setting("coordinator_url").rstrip("/")                  # Rỗng = tự đọc sheet như cũ
+COORDINATOR_BIND = _parse_bind(local_setting("coordinator_bind", "127.0.0.1:8765"))
+COORDINATOR_SECRET = local_setting("coordinator_secret")  # Bắt buộc khi bind ra ngoài loopback
+COORDINATOR_SECRET_HEADER = "X-Coordinator-Secret"
+COORDINATOR_STATUSES = {"ĐÃ ĐĂNG"}       # Trạng thái worker được phép ghi lên sheet
+COORDINATOR_REFRESH_SEC = 10 * 60        # Chu kỳ kiểm tra sheet đổi (modifiedTime) để tải lại INPUT
+COORDINATOR_FLUSH_SEC = 60               # Chu kỳ ghi lô trạng thái worker báo về lên sheet
+
+_QUEUE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+    idx INTEGER PRIMARY KEY,
+    code TEXT,
+    channel TEXT,
+    row TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_queue_channel ON queue(channel);
+CREATE TABLE IF NOT EXISTS reports (
+    code TEXT PRIMARY KEY,
+    channel TEXT,
+    status TEXT,
+    state TEXT,
+    error TEXT,
+    reported_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def _kv_get(key):
+    row = _journal_exec("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+    return json.loads(row["value"]) if row else None
+
+def _kv_set(key, value):
+    _journal_exec("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+def refresh_queue():
+    """Tải INPUT một lần, chia theo kênh vào bảng queue. Trả về version (đổi khi dữ liệu đổi)."""
+    rows = get_rows(INPUT_SHEET)
+    version = hashlib.md5(json.dumps(rows, ensure_ascii=False).encode("utf-8")).hexdigest()
+    if version == _kv_get("version"):
+        return version
+    
+    now = time.time()
+    with _JOURNAL_LOCK:
+        conn = journal()
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM queue")
+        conn.executemany("INSERT INTO queue (idx, code, channel, row, updated_at) VALUES (?, ?, ?, ?, ?)",
+                         [(i, norm(row[0]), norm(row[34]) if len(row) > 34 else None,
+                           json.dumps(row, ensure_ascii=False), now)
+                          for i, row in enumerate(rows[1:], start=2) if row and norm(row[0])])
+        conn.execute("COMMIT")
+        _kv_set("header", rows[0] if rows else [])
+        _kv_set("version", version)
+    logging.info(f"📥 Queue: {len(rows) - 1} dòng INPUT, version {version[:8]}")
+    return version
+
+def queue_has(code, channel):
+    """Mã có trong queue của kênh không (worker chỉ được báo mã của kênh mình)."""
+    return _journal_exec("SELECT 1 FROM queue WHERE code = ? AND channel = ?", (code, channel)).fetchone() is not None
+
+def queue_rows(channel):
+    """Các dòng INPUT của kênh (kèm dòng tiêu đề) — cùng cấu trúc với get_rows()."""
+    rows = _journal_exec("SELECT row FROM queue WHERE channel = ? ORDER BY idx", (channel,)).fetchall()
+    return [_kv_get("header") or []] + [json.loads(r["row"]) for r in rows]
+
+def record_report(report):
+    """Lưu báo cáo của worker; status mới vào hàng đợi ghi, lên sheet ở lần flush kế tiếp."""
+    _journal_exec("INSERT INTO reports (code, channel, status, state, error, reported_at) "
+                  "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(code) DO UPDATE SET "
+                  "channel = excluded.channel, state = COALESCE(excluded.state, state), "
+                  "error = excluded.error, reported_at = excluded.reported_at, "
+                  "status = COALESCE(excluded.status, status)",
+                  (report["code"], report.get("channel"), report.get("status"), report.get("state"),
+                   report.get("error"), time.time()))
+    if report.get("status"):
+        queue_status(report["code"], report["status"])
+
+class _CoordinatorHandler(BaseHTTPRequestHandler):
+    def _send(self, code, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _authorized(self):
+        if not COORDINATOR_SECRET:
+            return True
+        if hmac.compare_digest(self.headers.get(COORDINATOR_SECRET_HEADER, ""), COORDINATOR_SECRET):
+            return True
+        self._send(401, {"error": "unauthorized"})
+        return False
+    
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/version":
+            self._send(200, {"version": _kv_get("version")})
+        elif url.path == "/jobs" and query.get("channel"):
+            self._send(200, {"version": _kv_get("version"), "rows": queue_rows(query["channel"][0])})
+        else:
+            self._send(404, {"error": "not found"})
+    
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path != "/report":
+            return self._send(404, {"error": "not found"})
+        try:
+            report = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if not report.get("code"):
+                raise ValueError("thiếu code")
+            if report.get("status") and report["status"] not in COORDINATOR_STATUSES:
+                raise ValueError(f"trạng thái không hợp lệ: {report['status']}")
+            if not queue_has(report["code"], report.get("channel")):
+                raise ValueError(f"mã {report['code']} không thuộc kênh {report.get('channel')}")
+            record_report(report)
+            self._send(200, {"ok": True})
+        except Exception as e:
+            self._send(400, {"error": str(e)})
     
+    def log_message(self, fmt, *args):
+        logging.debug(f"coordinator: {fmt % args}")
+
+def run_coordinator():
+    """Chạy coordinator: HTTP server + vòng tải lại queue / ghi lô trạng thái / tự cập nhật."""
+    if not COORDINATOR_SECRET and COORDINATOR_BIND[0] not in ("127.0.0.1", "localhost", "::1"):
+        logging.error(f"Bind {COORDINATOR_BIND[0]} ra ngoài máy cần coordinator_secret (local.json hoặc UPLOAD_COORDINATOR_SECRET)")
+        sys.exit(1)
+    journal().executescript(_QUEUE_SCHEMA)
+    refresh_queue()
+    last_mod = sheet_modified_time()
+    
+    server = ThreadingHTTPServer(COORDINATOR_BIND, _CoordinatorHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="coordinator-http").start()
+    logging.info(f"🛰️ Coordinator chạy tại http://{COORDINATOR_BIND[0]}:{COORDINATOR_BIND[1]}")
+    
+    last_refresh = time.time()
+    while True:
+        time.sleep(COORDINATOR_FLUSH_SEC)
+        try:
+            check_for_updates()  # Tự giới hạn 1 lần/giờ; có bản mới thì os.execv với cùng --coordinator
+            flush_status_queue()
+            if time.time() - last_refresh >= COORDINATOR_REFRESH_SEC:
+                last_refresh = time.time()
+                mod = sheet_modified_time()
+                if mod is None or mod != last_mod:
+                    last_mod = mod
+                    invalidate_cache()
+                    refresh_queue()
+        except Exception as e:
+            logging.warning(f"Lỗi coordinator: {e}")
+
+def _coordinator_headers():
+    return {COORDINATOR_SECRET_HEADER: COORDINATOR_SECRET} if COORDINATOR_SECRET else {}
+
+def coordinator_rows():
+    """Worker: lấy dòng INPUT của kênh mình từ coordinator. None nếu không dùng/không kết nối được."""
+    if not COORDINATOR_URL:
+        return None
+    try:
+        resp = requests.get(f"{COORDINATOR_URL}/jobs", params={"channel": CFG["CHANNEL_CODE"]},
+                            headers=_coordinator_headers(), timeout=15)
+        resp.raise_for_status()
+        data = resp.json()
+        _COORDINATOR_STATE["version"] = data.get("version")
+        return data["rows"]
+    except Exception as e:
+        logging.warning(f"Không lấy được việc từ coordinator ({e}) → đọc sheet trực tiếp")
+        return None
+
+def coordinator_version():
+    """Worker: version dữ liệu của coordinator (thay cho modifiedTime của sheet)."""
+    try:
+        return requests.get(f"{COORDINATOR_URL}/version", headers=_coordinator_headers(),
+                            timeout=10).json().get("version")
+    except Exception:
+        return None
+
+def report_to_coordinator(code, status=None, state=None, error=None):
+    """Worker: báo trạng thái mã về coordinator. Trả về True nếu coordinator đã nhận."""
+    if not COORDINATOR_URL:
+        return False
+    try:
+        resp = requests.post(f"{COORDINATOR_URL}/report", headers=_coordinator_headers(), timeout=15, json={
+            "code": code, "channel": CFG["CHANNEL_CODE"], "status": status, "state": state, "error": error})
+        return resp.status_code == 200
+    except Exception as e:
+        logging.warning(f"Không báo được coordinator: {e}")
+        return False
+
+_COORDINATOR_STATE = {}
+
+def load_input_rows():
+    """Dòng INPUT cho vòng này: từ coordinator nếu có, ngược lại đọc sheet."""
+    rows = coordinator_rows()
+    return rows if rows is not None else get_rows(INPUT_SHEET)
+
+def publish_status(code, status):
+    """Ghi trạng thái mã: qua coordinator nếu có, ngược lại vào hàng đợi ghi lô (flush theo cửa sổ thời gian)."""
+    if report_to_coordinator(code, status=status, state=load_checkpoint(code)):
+        logging.info(f"📨 Đã báo coordinator: {code} → {status}")
+        return True
+    queue_status(code, status)
+    flush_status_queue(force=False)
     return True
 
+# ================== TEMPLATE CAPTURE ==================
+def capture_template(name, x, y, w, h):
+    """
+    Cắt vùng (x, y, w, h) — tọa độ vật lý — từ màn hình hiện tại thành icon/<file của NAME>.
+    Dùng trên máy RDP khi màn hình đang hiện đúng trạng thái cần chụp.
+    """
+    if name not in TEMPLATES:
+        logging.error(f"Không có template tên {name}")
+        return 1
+    frame = grab_frame()
+    image = frame.image if frame.image is not None else Image.fromarray(frame.gray)
+    path = icon(name)
+    image.crop((x, y, x + w, y + h)).save(path)
+    invalidate_templates(path)
+    logging.info(f"🖼️ Đã lưu {path} ({w}x{h})")
+    return 0
+
+# ================== BENCHMARK ==================
+# Corpus: thư mục ảnh chụp YouTube Studio (*.png) + labels.json:
+#   {"anh1.png": {"NEXT_BTN": [x, y], "SAVE": null}, "anh2.png": ["BUOC2"], ...}
+# Template có trong nhãn của ảnh = positive (kèm tâm nếu biết), còn lại = negative.
+BENCH_LEVELS = [0.9, 0.85, 0.8, 0.75, 0.7, 0.65, 0.6]
+BENCH_CONF = 0.8       # Ngưỡng dùng để chấm đúng/sai khi làm regression gate
+BENCH_MAX_SLOWDOWN = 1.5  # p90 chậm hơn baseline quá mức này thì coi là regression
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def load_corpus_labels(corpus_dir):
+    """Đọc labels.json -> {file: {template_name: (x, y) hoặc None}}."""
+    with open(os.path.join(corpus_dir, "labels.json"), encoding="utf-8") as f:
+        raw = json.load(f)
+    labels = {}
+    for fname, items in raw.items():
+        if isinstance(items, dict):
+            labels[fname] = {k: tuple(v) if v else None for k, v in items.items()}
+        else:
+            labels[fname] = {k: None for k in items}
+    return labels
+
+def collect_corpus_scores(corpus_dir, names=None):
+    """
+    Chạy mọi template trên mọi ảnh trong corpus (quét cả màn hình, không dùng vị trí nhớ).
+    Trả về {name: [(file, score, x, y, ms, expected_pos, is_positive), ...]}.
+    """
+    global LAST_HITS_PATH, _LAST_HITS
+    labels = load_corpus_labels(corpus_dir)
+    names = [n for n in (names or TEMPLATES) if template_available(n)]
+    saved_path, LAST_HITS_PATH, _LAST_HITS = LAST_HITS_PATH, None, {}
+    set_capture_backend("replay", corpus_dir)
+    results = {n: [] for n in names}
+    try:
+        for fname in _CAPTURE["files"]:
+            frame = grab_frame()
+            if fname not in labels:
+                continue
+            for name in names:
+                # Giữ tỉ lệ đã chốt, bỏ vị trí nhớ để đo đúng chi phí quét cả màn hình
+                _LAST_HITS = {k: v for k, v in _LAST_HITS.items() if k == "__scale__"}
+                frame.scores.pop(icon(name), None)
+                t0 = time.perf_counter()
+                score, x, y = match_template(frame, icon(name), min(BENCH_LEVELS))
+                ms = (time.perf_counter() - t0) * 1000
+                positive = name in labels[fname]
+                results[name].append((fname, score, x, y, ms, labels[fname].get(name), positive))
+    finally:
+        LAST_HITS_PATH, _LAST_HITS = saved_path, None
+        # Backend thật được chọn lại ở lần chụp kế tiếp (không cần màn hình khi chỉ chạy benchmark)
+        _CAPTURE.clear()
+        _DISPLAY.clear()
+    return results
+
+def _is_correct_hit(name, x, y, expected):
+    """Vị trí khớp có nằm trong khung template quanh tâm mong đợi không (không có tâm thì coi là đúng)."""
+    if x is None:
+        return False
+    if expected is None:
+        return True
+    tpl = load_template(icon(name))
+    return abs(x - expected[0]) <= tpl.w // 2 and abs(y - expected[1]) <= tpl.h // 2
+
+def summarize_template(name, samples, threshold=None):
+    """Tổng hợp latency, đúng/sai theo từng ngưỡng và biên điểm số cho một template."""
+    if threshold is None:
+        threshold = template_threshold(icon(name), BENCH_CONF)
+    lat = [s[4] for s in samples]
+    pos = [s for s in samples if s[6]]
+    neg = [s for s in samples if not s[6]]
+    
+    levels = {}
+    for lv in sorted(set(BENCH_LEVELS + [threshold]), reverse=True):
+        tp = sum(1 for s in pos if s[1] >= lv and _is_correct_hit(name, s[2], s[3], s[5]))
+        fp = sum(1 for s in neg if s[1] >= lv) + \
+             sum(1 for s in pos if s[1] >= lv and not _is_correct_hit(name, s[2], s[3], s[5]))
+        levels[f"{lv:.2f}"] = {"tp": tp, "fn": len(pos) - tp, "fp": fp, "tn": len(neg) - sum(1 for s in neg if s[1] >= lv)}
+    
+    min_pos = min((s[1] for s in pos), default=None)
+    max_neg = max((s[1] for s in neg), default=None)
+    return {
+        "samples": len(samples),
+        "positives": len(pos),
+        "negatives": len(neg),
+        "latency_ms": {"p50": _percentile(lat, 50), "p90": _percentile(lat, 90), "p99": _percentile(lat, 99)},
+        "min_positive_score": min_pos,
+        "max_negative_score": max_neg,
+        "margin": (min_pos - max_neg) if min_pos is not None and max_neg is not None else None,
+        "threshold": threshold,
+        "levels": levels,
+    }
+
+def run_benchmark(corpus_dir, report_path=None, baseline_path=None):
+    """
+    Benchmark nhận diện ảnh trên corpus. Ghi report JSON, so với baseline (nếu có).
+    Trả về 0 nếu đạt, 1 nếu có regression (sai ở ngưỡng chấm hoặc chậm hơn baseline).
+    """
+    logging.info(f"📊 Benchmark corpus: {corpus_dir}")
+    report = {"version": VERSION, "created": datetime.now().isoformat(timespec="seconds"), "templates": {}}
+    for name, samples in collect_corpus_scores(corpus_dir).items():
+        report["templates"][name] = summarize_template(name, samples)
+    
+    baseline = {}
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f).get("templates", {})
+    
+    failed = False
+    for name, st in report["templates"].items():
+        lv = st["levels"][f"{st['threshold']:.2f}"]
+        margin = f"{st['margin']:+.3f}" if st["margin"] is not None else "n/a"
+        logging.info(f"  {name:16s} p50={st['latency_ms']['p50'] or 0:7.1f}ms p90={st['latency_ms']['p90'] or 0:7.1f}ms "
+                     f"tp={lv['tp']} fn={lv['fn']} fp={lv['fp']} margin={margin}")
+        problems = []
+        if lv["fn"] or lv["fp"]:
+            problems.append(f"sai ở ngưỡng {st['threshold']:.2f}")
+        base_p90 = baseline.get(name, {}).get("latency_ms", {}).get("p90")
+        if base_p90 and st["latency_ms"]["p90"] and st["latency_ms"]["p90"] > base_p90 * BENCH_MAX_SLOWDOWN:
+            problems.append(f"p90 {st['latency_ms']['p90']:.1f}ms > {BENCH_MAX_SLOWDOWN}x baseline {base_p90:.1f}ms")
+        if problems:
+            failed = True
+            logging.warning(f"  ✗ {name}: {'; '.join(problems)}")
+    
+    report_path = report_path or os.path.join(corpus_dir, "bench_report.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    logging.info(f"📄 Report: {report_path}")
+    logging.info("❌ Benchmark có regression" if failed else "✅ Benchmark đạt")
+    return 1 if failed else 0
+
+# ---- Hiệu chỉnh ngưỡng: một ngưỡng tách hit/miss cho mỗi template thay cho thang confidence ----
+CALIBRATION_SLACK = 0.05          # Ngưỡng = điểm positive thấp nhất trừ đi khoảng này...
+CALIBRATION_MARGIN = 0.05         # ...nhưng luôn cao hơn điểm negative cao nhất ít nhất chừng này
+CALIBRATION_RANGE = (0.6, 0.98)   # Không bao giờ thấp hơn đáy thang confidence cũ
+
+def calibrate_threshold(name, samples):
+    """Ngưỡng tốt nhất cho template từ điểm số corpus, hoặc None nếu không có ảnh positive."""
+    pos = [s[1] for s in samples if s[6] and _is_correct_hit(name, s[2], s[3], s[5])]
+    neg = [s[1] for s in samples if not s[6] or not _is_correct_hit(name, s[2], s[3], s[5])]
+    if not pos:
+        return None
+    
+    if not neg or min(pos) > max(neg):
+        thr = min(pos) - CALIBRATION_SLACK
+        if neg:
+            # Khoảng cách hẹp hơn margin: lấy sát positive thấp nhất còn hơn ăn vào vùng negative
+            thr = min(min(pos), max(thr, max(neg) + CALIBRATION_MARGIN))
+    else:
+        # Hai tập chồng nhau: chọn ngưỡng ít lỗi nhất, một false click tính nặng gấp đôi một lần trượt
+        def cost(t):
+            return sum(1 for v in pos if v < t) + 2 * sum(1 for v in neg if v >= t)
+        thr = min(sorted(set(pos)), key=cost)
+    
+    lo, hi = CALIBRATION_RANGE
+    return round(min(hi, max(lo, thr)), 3)
+
+def run_calibration(corpus_dir):
+    """Tính ngưỡng cho mọi template có ảnh positive trong corpus, ghi vào icon/thresholds.json."""
+    logging.info(f"🎯 Hiệu chỉnh ngưỡng từ corpus: {corpus_dir}")
+    thresholds = dict(load_thresholds())
+    for name, samples in collect_corpus_scores(corpus_dir).items():
+        thr = calibrate_threshold(name, samples)
+        if thr is None:
+            logging.info(f"  {name:16s} bỏ qua (không có ảnh positive)")
+            continue
+        thresholds[name] = thr
+        logging.info(f"  {name:16s} ngưỡng={thr:.3f}")
+    
+    with open(THRESHOLDS_PATH, "w", encoding="utf-8") as f:
+        json.dump(thresholds, f, ensure_ascii=False, indent=2, sort_keys=True)
+    load_thresholds()
+    logging.info(f"📄 Đã ghi: {THRESHOLDS_PATH}")
+    return 0
+
 # ================== MAIN ==================
 def main():
     random.seed()
@@ -1045,15 +3200,19 @@ def main():
     # Kiểm tra update
     check_for_updates()
     
-    # Dọn mã đã đăng
-    cleanup_posted_codes()
+    # Nạp sẵn template icon
+    preload_templates()
     
     BROWSER_WAIT = int(r(*RANDOM.browser_launch_wait_sec))
     TIMEOUT = int(r(*RANDOM.click_timeout_sec))
     CONF = r(*RANDOM.click_confidence)
     
-    client = gs_client()
-    input_rows = get_rows(client, INPUT_SHEET)
+    # Ghi nốt trạng thái còn treo từ vòng trước (crash/mất mạng)
+    flush_status_queue()
+    input_rows = load_input_rows()
+    
+    # Dọn mã đã đăng
+    cleanup_posted_codes(input_rows)
     
     # Lấy mã cần đăng
     ready_codes = get_all_ready_codes(input_rows)
@@ -1061,12 +3220,7 @@ def main():
         logging.info(f"Không có mã cho {CFG['CHANNEL_CODE']} hôm nay")
         
         # Pre-stage ngày mai
-        tomorrow = get_tomorrow_codes(input_rows)
-        for c in tomorrow:
-            try:
-                ensure_local_folder(c)
-            except Exception:
-                pass
+        prestage_codes(get_tomorrow_codes(input_rows))
         return
     
     # Lọc mã có file
@@ -1081,94 +3235,83 @@ def main():
     logging.info(f"📋 Đăng {len(ready_codes)} mã: {ready_codes}")
     
     # Pre-stage
-    for c in ready_codes:
-        try:
-            ensure_local_folder(c)
-        except Exception:
-            pass
+    prestage_codes(ready_codes)
     
     # Mở browser
     logging.info(f"🌐 Mở browser: {CFG['RUN_BROWSER_EXE']}")
     open_run_and_execute(CFG["RUN_BROWSER_EXE"])
-    time.sleep(BROWSER_WAIT)
+    nap(BROWSER_WAIT)
     
-    # Upload từng mã
+    # Upload từng mã: mã N đang chờ xử lý trong tab của nó thì mã N+1 đã bắt đầu ở tab mới
     first_time = True
     processed = set()
+    settling = {}
     
     for idx, code in enumerate(ready_codes, 1):
         if code in processed:
             continue
         
+        wait_settling(settling, PIPELINE_MAX_SETTLING - 1)
+        
         logging.info(f"=== [{idx}/{len(ready_codes)}] CODE: {code} ===")
         
         active_row = find_row_by_code(input_rows, code)
         if not active_row:
             continue
         
-        target_folder = FOLDER_PATTERN.format(code=code)
+        if _reached(load_checkpoint(code), STATE_SCHEDULED):
+            logging.info(f"⏭️ {code}: đã hẹn lịch trước đó")
+            processed.add(code)
+            continue
+        
         if not ensure_local_folder(code):
+            journal_error(code, "Thiếu file local/server")
             continue
         
         # Điều hướng
         if not first_time:
             pyautogui.hotkey('ctrl', 't'); rsleep("small")
+        first_time = False
         
-        pyautogui.hotkey('ctrl', 'l'); rsleep("tiny")
-        paste_text(UPLOAD_URL)
-        pyautogui.press('enter'); rsleep("medium")
-        
-        # Phóng to
+        journal_attempt(code)
         try:
-            pyautogui.keyDown('alt'); pyautogui.press('space'); pyautogui.keyUp('alt'); rsleep("tiny")
-            pyautogui.press('x'); rsleep("small")
-        except Exception:
-            pass
-        
-        pyautogui.press('f5'); rsleep("medium")
-        
-        # Click Select files
-        if not wait_and_click_image(icon("SELECT_BTN"), timeout_sec=TIMEOUT, confidence=CONF):
-            pyautogui.press('f5'); rsleep("medium")
-            if not wait_and_click_image(icon("SELECT_BTN"), timeout_sec=60, confidence=CONF):
-                continue
-        
-        # Chọn video
-        if not wait_image(icon("OPEN_READY"), timeout_sec=TIMEOUT, confidence=CONF):
-            first_time = False
-            continue
-        
-        file_dialog_select_first_mp4(target_folder)
-        
-        # Metadata
-        if not wait_image(icon("NEXT_BTN"), timeout_sec=TIMEOUT, confidence=CONF):
-            first_time = False
+            ok = run_upload(code, active_row, TIMEOUT, CONF)
+        except Exception as e:
+            logging.error(f"Lỗi upload {code}: {e}")
+            journal_error(code, e)
             continue
-        
-        handle_metadata_flow(active_row)
-        
-        # Step 2
-        if not handle_step2_flow(active_row):
-            # Fallback an toàn: chờ upload xong rồi mới F5
-            safe_fallback_step2()
-        
-        # Step 3-4
-        if handle_step3_4_flow(active_row, client, code):
+        finally:
+            export_metrics(code)
+        if ok:
             processed.add(code)
-        
-        first_time = False
+            settling[code] = time.time() + SETTLE_SEC
+        else:
+            journal_error(code, f"Dừng sau bước {load_checkpoint(code)}")
+    
+    # Đợi các tab còn đang xử lý trước khi kết thúc (vòng sau sẽ đóng browser)
+    wait_settling(settling)
+    flush_status_queue()
     
     logging.info(f"✅ Hoàn thành {len(processed)}/{len(ready_codes)} mã")
     
     # Pre-stage ngày mai
-    try:
-        tomorrow = get_tomorrow_codes(input_rows)
-        for c in tomorrow:
-            ensure_local_folder(c)
-    except Exception:
-        pass
+    prestage_codes(get_tomorrow_codes(input_rows))
 
 if __name__ == "__main__":
+    # python main.py --bench <corpus_dir> [report.json] [baseline.json]
+    if len(sys.argv) > 2 and sys.argv[1] == "--bench":
+        sys.exit(run_benchmark(*sys.argv[2:5]))
+    # python main.py --calibrate <corpus_dir>
+    if len(sys.argv) > 2 and sys.argv[1] == "--calibrate":
+        sys.exit(run_calibration(sys.argv[2]))
+    # python main.py --capture-template <NAME> <x> <y> <w> <h>
+    if len(sys.argv) > 6 and sys.argv[1] == "--capture-template":
+        sys.exit(capture_template(sys.argv[2], *map(int, sys.argv[3:7])))
+    # python main.py --coordinator
+    if len(sys.argv) > 1 and sys.argv[1] == "--coordinator":
+        run_coordinator()
+    
+    load_upload_config()
     while True:
         try:
             close_browsers()
@@ -1186,5 +3329,9 @@ if __name__ == "__main__":
             else:
                 logging.error(f"Lỗi main(): {e}")
         
-        # Nghỉ 3 tiếng
-        time.sleep(3 * 60 * 60)
+        # Nghỉ tới khi cần đăng mã kế tiếp (tối đa 3 tiếng)
+        try:
+            sleep_until_next_run()
+        except Exception as e:
+            logging.warning(f"Lỗi lập lịch: {e}")
+            time.sleep(MAX_IDLE_SEC)
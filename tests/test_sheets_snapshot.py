@@ -0,0 +1,69 @@
+"""
+Snapshot Sheets trên đĩa: dùng lại khi modifiedTime không đổi, tải lại khi đổi.
+Chạy với sheet local (set_sheets_backend) nên không cần mạng/creds.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.sheet_path = os.path.join(self.tmp.name, f"{main.INPUT_SHEET}.json")
+        self.write_rows([["code", "kênh"], ["A1", "CH1"]], mtime=1_700_000_000)
+
+        self.saved_journal = main.JOURNAL_PATH
+        main.JOURNAL_PATH = os.path.join(self.tmp.name, "journal.db")
+        main._JOURNAL.clear()
+        main.set_sheets_backend(self.tmp.name)
+
+        self.fetch = mock.patch.object(main, "get_projected_values", wraps=main.get_projected_values).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        main.set_sheets_backend(None)
+        if "conn" in main._JOURNAL:
+            main._JOURNAL.pop("conn").close()
+        main.JOURNAL_PATH = self.saved_journal
+        self.tmp.cleanup()
+
+    def write_rows(self, rows, mtime):
+        with open(self.sheet_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False)
+        os.utime(self.sheet_path, (mtime, mtime))
+
+    def read(self):
+        main.invalidate_cache()  # Bỏ cache RAM (và modifiedTime đã nhớ) -> chỉ còn snapshot trên đĩa
+        return main.sheet_values(main.INPUT_SHEET)
+
+    def test_unchanged_modified_time_reuses_snapshot(self):
+        first = self.read()
+        self.assertEqual(self.fetch.call_count, 1)
+
+        second = self.read()
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(second, first)
+
+    def test_changed_modified_time_refetches(self):
+        self.read()
+        self.write_rows([["code", "kênh"], ["A1", "CH1"], ["A2", "CH2"]], mtime=1_700_000_060)
+
+        rows = self.read()
+        self.assertEqual(self.fetch.call_count, 2)
+        self.assertEqual(rows[-1][0], "A2")
+
+    def test_modified_time_is_utc(self):
+        self.assertEqual(main.sheet_modified_time(), "2023-11-14T22:13:20.000000Z")
+
+
+if __name__ == "__main__":
+    unittest.main()